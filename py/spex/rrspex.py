@@ -13,7 +13,9 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
+import logging
 import traceback
+import multiprocessing
 
 import argparse
 
@@ -22,19 +24,118 @@ from scipy import sparse
 
 from astropy.io import fits
 from astropy.table import Table, join
+from astropy import units
 import astropy.wcs as wcs
 import matplotlib.pyplot as plt
 
 from redrock.utils import elapsed, get_mp
-from redrock.targets import Spectrum, Target, DistTargetsCopy
-from redrock.templates import load_dist_templates, find_templates, Template
-from redrock.results import write_zscan
-from redrock.zfind import zfind
+from redrock.targets import Spectrum, Target
+from redrock.templates import find_templates, Template
 from redrock._version import __version__
-from redrock.archetypes import All_archetypes
 
 from .utils import plot_zfit_check, get_mask_intervals, plot_scandata
 
+log = logging.getLogger(__name__)
+
+try:
+    import fitsio
+except ImportError:
+    HAS_FITSIO = False
+else:
+    HAS_FITSIO = True
+
+try:
+    import numba
+except ImportError:
+    HAS_NUMBA = False
+else:
+    HAS_NUMBA = True
+
+# Header keywords that may contain the id of the object
+VALID_ID_KEYS = tuple(
+    f"{i}{j}"
+    for i in ('', 'OBJ', 'OBJ_', 'TARGET', 'TARGET_')
+    for j in ('ID', 'NUMBER', 'UID', 'UUID')
+)
+
+# Lowercase HDU names used to classify the content of each extension
+_SPEC_NAMES = frozenset(('spec', 'spectrum', 'data'))
+_MASK_NAMES = frozenset(('mask', 'nanmask', 'nan_mask', 'nans'))
+_VAR_NAMES = frozenset(('var', 'variance', 'stat'))
+_IVAR_NAMES = frozenset(('ivar', 'ivariance'))
+_WD_NAMES = frozenset(('wd', 'dispersion', 'resolution'))
+
+
+if HAS_NUMBA:
+    @numba.njit(cache=True, fastmath=True)
+    def _dia_matvec(data, offsets, v):
+        """
+        Compute the matrix-vector product of a DIA matrix with a vector.
+
+        Same diagonal storage convention as scipy.sparse.dia_matrix:
+        M[c - offsets[i], c] = data[i, c].
+        """
+        n = v.shape[0]
+        result = np.zeros_like(v)
+        for i in range(offsets.shape[0]):
+            k = offsets[i]
+            c_start = k if k > 0 else 0
+            c_stop = n + k if k < 0 else n
+            for c in range(c_start, c_stop):
+                result[c - k] += data[i, c] * v[c]
+        return result
+
+
+class DiagResolution:
+    """
+    Lightweight diagonal resolution matrix with a Numba accelerated matvec.
+
+    redrock only uses the resolution matrix for matrix-vector products, but
+    performs millions of them during the redshift scan; scipy.sparse pays
+    format checks and Python-level dispatch on every call. This shim stores
+    the diagonals directly and runs the offset-diagonal accumulation in a
+    compiled kernel, exposing just the small subset of the scipy.sparse
+    interface that redrock consumes.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The diagonals of the matrix, one per row, using the same storage
+        convention of scipy.sparse.dia_matrix.
+    offsets : numpy.ndarray or sequence of int
+        The offset of each diagonal in data.
+    shape : 2-tuple of int
+        The shape of the matrix.
+
+    """
+
+    __slots__ = ('data', 'offsets', 'shape')
+
+    def __init__(self, data, offsets, shape):
+        self.data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        self.offsets = np.atleast_1d(np.asarray(offsets, dtype=np.int64))
+        self.shape = tuple(shape)
+
+    def dot(self, v):
+        """Compute the matrix-vector product with v."""
+        return _dia_matvec(self.data, self.offsets, np.asarray(v))
+
+    def __matmul__(self, v):
+        return self.dot(v)
+
+    def _as_dia_matrix(self):
+        return sparse.dia_matrix(
+            (self.data, self.offsets), shape=self.shape
+        )
+
+    def toarray(self):
+        """Return the dense version of the matrix."""
+        return self._as_dia_matrix().toarray()
+
+    def tocsr(self):
+        """Return the matrix converted to scipy CSR format."""
+        return self._as_dia_matrix().tocsr()
+
 
 def get_templates(template_types=[], filepath=False, templates=None):
     """
@@ -107,14 +208,26 @@ def write_zbest(outfile, zbest, template_version, archetype_version):
     header = fits.Header()
     header['RRVER'] = (__version__, 'Redrock version')
 
-    for i, fulltype in enumerate(template_version.keys()):
-        header['TEMNAM'+str(i).zfill(2)] = fulltype
-        header['TEMVER'+str(i).zfill(2)] = template_version[fulltype]
+    hdr_cards = {
+        f'TEMNAM{i:02d}': fulltype
+        for i, fulltype in enumerate(template_version)
+    }
+    hdr_cards.update({
+        f'TEMVER{i:02d}': version
+        for i, version in enumerate(template_version.values())
+    })
 
     if archetype_version is not None:
-        for i, fulltype in enumerate(archetype_version.keys()):
-            header['ARCNAM'+str(i).zfill(2)] = fulltype
-            header['ARCVER'+str(i).zfill(2)] = archetype_version[fulltype]
+        hdr_cards.update({
+            f'ARCNAM{i:02d}': fulltype
+            for i, fulltype in enumerate(archetype_version)
+        })
+        hdr_cards.update({
+            f'ARCVER{i:02d}': version
+            for i, version in enumerate(archetype_version.values())
+        })
+
+    header.update(hdr_cards)
 
     zbest.meta['EXTNAME'] = 'ZBEST'
 
@@ -125,9 +238,280 @@ def write_zbest(outfile, zbest, template_version, archetype_version):
     return
 
 
-def read_spectra(spectra_fits_list, spec_hdu=None, var_hdu=None, wd_hdu=None):
+def _fitsio_header_to_astropy(fitsio_header):
     """
-    Read input spectra fits files.
+    Convert a fitsio header to an astropy one.
+
+    Parameters
+    ----------
+    fitsio_header : fitsio.FITSHDR
+        The header read with fitsio.
+
+    Returns
+    -------
+    header : astropy.io.fits.Header
+        The same header as an astropy object.
+
+    """
+    header = fits.Header()
+    for record in fitsio_header.records():
+        try:
+            header[record['name']] = (record['value'], record['comment'])
+        except (KeyError, ValueError):
+            continue
+    return header
+
+
+def _ivar_from_var(var):
+    """
+    Compute the inverse variance of the spectral data.
+
+    The variance is converted to float32 (without copying when the input is
+    already float32) and the reciprocal is computed in a single pass instead
+    of allocating an intermediate float64 array. Pixels with non-positive
+    variance get a zero inverse variance instead of a silent inf.
+
+    Parameters
+    ----------
+    var : numpy.ndarray
+        The variance of the spectral data.
+
+    Returns
+    -------
+    ivar : numpy.ndarray
+        The inverse variance of the spectral data.
+
+    """
+    var = var.astype(np.float32, copy=False)
+    ivar = np.zeros_like(var)
+    np.divide(1.0, var, out=ivar, where=var > 0)
+    return ivar
+
+
+def _read_spectrum_fitsio(fits_file, spec_hdu=None, var_hdu=None, wd_hdu=None):
+    """
+    Read a single spectrum fits file using fitsio.
+
+    fitsio indexes the HDUs at C level and is much faster than astropy when
+    opening many small files just to pull a couple of HDUs out of each one.
+
+    Parameters
+    ----------
+    fits_file : str
+        The path of the fits file containing the input spectrum.
+    spec_hdu : int or None, optional
+        The index of the HDU that contains the spectral data itself.
+        The default value is None.
+    var_hdu : int or None, optional
+        The index of the HDU that contains the variance of the spectral data.
+        The default value is None.
+    wd_hdu : int or None, optional
+        The index of the HDU that contains the wavelength dispersion.
+        The default value is None.
+
+    Raises
+    ------
+    ValueError
+        If cannot automatically determine the HDU containing the specral data.
+
+    Returns
+    -------
+    flux : numpy.ndarray
+        The spectral data.
+    ivar : numpy.ndarray
+        The inverse variance of the spectral data.
+    wd : numpy.ndarray or None
+        The wavelength dispersion data, if any.
+    nanmask : numpy.ndarray or None
+        The mask of invalid pixels, if any.
+    spec_wcs : astropy.wcs.WCS
+        The WCS of the spectral data.
+    main_header : fitsio.FITSHDR
+        The header of the primary HDU.
+    spec_id : str or None
+        The id of the object, if present in the headers.
+
+    """
+    spec_id = None
+    flux = None
+    ivar = None
+    wd = None
+    nanmask = None
+    spec_wcs = None
+
+    with fitsio.FITS(fits_file) as f:
+        main_header = f[0].read_header()
+
+        for hdu in f:
+            header = hdu.read_header()
+
+            if spec_id is None:
+                for key in VALID_ID_KEYS:
+                    val = header.get(key)
+                    if val is not None:
+                        spec_id = val
+                        break
+
+            name = hdu.get_extname().lower()
+            if flux is None and name in _SPEC_NAMES:
+                flux = hdu.read()
+                spec_wcs = wcs.WCS(_fitsio_header_to_astropy(header))
+            elif nanmask is None and name in _MASK_NAMES:
+                nanmask = hdu.read().astype(bool)
+            elif ivar is None and name in _VAR_NAMES:
+                ivar = _ivar_from_var(hdu.read())
+            elif ivar is None and name in _IVAR_NAMES:
+                ivar = hdu.read()
+            elif wd is None and name in _WD_NAMES:
+                wd = hdu.read()
+
+        # Manually specified HDU indices override the automatic detection
+        if spec_hdu is not None:
+            header = f[spec_hdu].read_header()
+            flux = f[spec_hdu].read()
+            spec_wcs = wcs.WCS(_fitsio_header_to_astropy(header))
+        if var_hdu is not None:
+            ivar = _ivar_from_var(f[var_hdu].read())
+        if wd_hdu is not None:
+            wd = f[wd_hdu].read()
+
+    if flux is None:
+        raise ValueError(
+            "Cannot determine the HDU containing spectral data: "
+            f"'{fits_file}'"
+        )
+
+    if ivar is None:
+        log.warning(
+            "Cannot determine the HDU containing variance "
+            f"data in '{fits_file}'! Using dumb constan variance..."
+        )
+        ivar = np.ones_like(flux)
+
+    return flux, ivar, wd, nanmask, spec_wcs, main_header, spec_id
+
+
+def _read_spectrum_astropy(fits_file, target_id, spec_hdu=None, var_hdu=None,
+                           wd_hdu=None):
+    """
+    Read a single spectrum fits file using astropy.
+
+    This is the fallback reader used when fitsio is not installed.
+
+    Parameters
+    ----------
+    fits_file : str
+        The path of the fits file containing the input spectrum.
+    target_id : str
+        The id to use for the object if none is found in the headers.
+    spec_hdu : int or None, optional
+        The index of the HDU that contains the spectral data itself.
+        The default value is None.
+    var_hdu : int or None, optional
+        The index of the HDU that contains the variance of the spectral data.
+        The default value is None.
+    wd_hdu : int or None, optional
+        The index of the HDU that contains the wavelength dispersion.
+        The default value is None.
+
+    Raises
+    ------
+    ValueError
+        If cannot automatically determine the HDU containing the specral data.
+
+    Returns
+    -------
+    flux : numpy.ndarray
+        The spectral data.
+    ivar : numpy.ndarray
+        The inverse variance of the spectral data.
+    wd : numpy.ndarray or None
+        The wavelength dispersion data, if any.
+    nanmask : numpy.ndarray or None
+        The mask of invalid pixels, if any.
+    spec_wcs : astropy.wcs.WCS
+        The WCS of the spectral data.
+    main_header : astropy.io.fits.Header
+        The header of the primary HDU.
+    spec_id : str
+        The id of the object.
+
+    """
+    spec_id = None
+    flux = None
+    ivar = None
+    wd = None
+    nanmask = None
+    spec_wcs = None
+
+    # Classify each HDU in a single pass instead of rescanning the HDU
+    # list once per data product.
+    with fits.open(
+        fits_file, mode='readonly', memmap=True, lazy_load_hdus=True
+    ) as hdul:
+        main_header = hdul[0].header
+
+        for hdu in hdul:
+            header = hdu.header
+            # Stop probing the id keywords at the first hit, so the
+            # headers of the remaining HDUs are not parsed just to search
+            # for an already-found keyword.
+            if spec_id is None:
+                for key in VALID_ID_KEYS:
+                    val = header.get(key)
+                    if val is not None:
+                        spec_id = val
+                        break
+
+            name = hdu.name.lower()
+            if flux is None and name in _SPEC_NAMES:
+                flux = hdu.data
+                spec_wcs = wcs.WCS(header)
+            elif nanmask is None and name in _MASK_NAMES:
+                nanmask = hdu.data.astype(bool)
+            elif ivar is None and name in _VAR_NAMES:
+                ivar = _ivar_from_var(hdu.data)
+            elif ivar is None and name in _IVAR_NAMES:
+                ivar = hdu.data
+            elif wd is None and name in _WD_NAMES:
+                wd = hdu.data
+
+        # Manually specified HDU indices override the automatic detection
+        if spec_hdu is not None:
+            flux = hdul[spec_hdu].data
+            spec_wcs = wcs.WCS(hdul[spec_hdu].header)
+        if var_hdu is not None:
+            ivar = _ivar_from_var(hdul[var_hdu].data)
+        if wd_hdu is not None:
+            wd = hdul[wd_hdu].data
+
+    if flux is None:
+        raise ValueError(
+            "Cannot determine the HDU containing spectral data: "
+            f"'{fits_file}'"
+        )
+
+    if ivar is None:
+        log.warning(
+            "Cannot determine the HDU containing variance "
+            f"data in '{fits_file}'! Using dumb constan variance..."
+        )
+        ivar = np.ones_like(flux)
+
+    if spec_id is None:
+        spec_id = target_id
+
+    return flux, ivar, wd, nanmask, spec_wcs, main_header, spec_id
+
+
+def iter_spectra(spectra_fits_list, spec_hdu=None, var_hdu=None, wd_hdu=None,
+                 use_fitsio=True):
+    """
+    Read input spectra fits files one at a time.
+
+    Reading the input files lazily bounds the peak memory usage of the
+    consumer, which can distribute or discard each target before the
+    following file is read.
 
     Parameters
     ----------
@@ -149,6 +533,10 @@ def read_spectra(spectra_fits_list, spec_hdu=None, var_hdu=None, wd_hdu=None):
         of the HDU. If this operation fails, no wavelenght dispersion will be
         used and the spectra will be considered having a uniform resolution.
         The default value is None.
+    use_fitsio : bool, optional
+        If it is True and the fitsio module is installed, use it to read the
+        input files instead of astropy (which is sensibly slower when dealing
+        with many small files). The default value is True.
 
     Raises
     ------
@@ -156,151 +544,286 @@ def read_spectra(spectra_fits_list, spec_hdu=None, var_hdu=None, wd_hdu=None):
         If cannot automatically determine the HDU containing the specral data
         or its variance.
 
+    Yields
+    ------
+    target : redrock.targets.Target
+        The target spectrum for which redshift will be computed.
+    meta_row : dict
+        The metadata of the target ('TARGETID', 'SPECID', 'SN' and 'SN_VAR').
+
+    """
+    for job in enumerate(spectra_fits_list):
+        yield _make_target(
+            _read_one((*job, spec_hdu, var_hdu, wd_hdu, use_fitsio))
+        )
+
+
+def _get_wavelengths(spec_wcs, npix):
+    """
+    Compute the wavelength grid, in Angstrom, of a spectrum.
+
+    For a linear spectral axis the wavelengths are computed with plain NumPy
+    arithmetic, bypassing the Quantity/SpectralCoord machinery that
+    spec_wcs.pixel_to_world() instantiates for every spectrum. The generic
+    astropy conversion is kept as fallback for non-linear axes.
+
+    Parameters
+    ----------
+    spec_wcs : astropy.wcs.WCS
+        The WCS of the spectral data.
+    npix : int
+        The number of pixels of the spectrum.
+
     Returns
     -------
-    targets : list of redrock.targets.Target
-        The target spectra for which redshift will be computed.
-    metatable : astropy.table.Table
-        A table containing metadata.
+    lam : numpy.ndarray
+        The wavelengths, in Angstrom, corresponding to each pixel.
 
     """
-    targets = []
-    targetids = []
-    specids = []
-    sn_vals = []
-    sn_var_vals = []
-    for j, fits_file in enumerate(spectra_fits_list):
-        hdul = fits.open(fits_file)
+    pixel = np.arange(npix)
 
-        valid_id_keys = [
-            f"{i}{j}"
-            for i in ['', 'OBJ', 'OBJ_', 'TARGET', 'TARGET_']
-            for j in ['ID', 'NUMBER', 'UID', 'UUID']
-        ]
+    # Linear axes have a bare CTYPE like 'WAVE' or 'AWAV', while non-linear
+    # ones carry an algorithm suffix (e.g. 'WAVE-LOG').
+    ctype = spec_wcs.wcs.ctype[0].strip().upper()
+    if ctype in ('WAVE', 'AWAV'):
+        crval = spec_wcs.wcs.crval[0]
+        crpix = spec_wcs.wcs.crpix[0]
+        cdelt = spec_wcs.wcs.cdelt[0]
+        lam = crval + (pixel - (crpix - 1)) * cdelt
+        return lam * units.Unit(spec_wcs.wcs.cunit[0]).to(units.Angstrom)
 
-        target_id = f"{j:09}"
-        spec_id = target_id
-        for hdu in hdul:
-            for key in valid_id_keys:
-                try:
-                    spec_id = hdu.header[key]
-                except KeyError:
-                    continue
-                else:
-                    break
-
-        if spec_hdu is None:
-            for hdu in hdul:
-                if hdu.name.lower() in ['spec', 'spectrum', 'data']:
-                    flux = hdu.data
-                    spec_wcs = wcs.WCS(hdu.header)
-                    break
-            else:
-                raise ValueError(
-                    "Cannot determine the HDU containing spectral data: "
-                    f"'{fits_file}'"
-                )
-        else:
-            flux = hdul[spec_hdu].data
-            spec_wcs = wcs.WCS(hdul[spec_hdu].header)
+    return spec_wcs.pixel_to_world(pixel).Angstrom
 
-        for hdu in hdul:
-            if hdu.name.lower() in ['mask', 'nanmask', 'nan_mask', 'nans']:
-                nanmask = hdu.data.astype(bool)
-                break
-        else:
-            nanmask = None
-
-        if var_hdu is None:
-            for hdu in hdul:
-                if hdu.name.lower() in ['var', 'variance', 'stat']:
-                    ivar = 1 / hdu.data
-                    break
-                elif hdu.name.lower in ['ivar', 'ivariance']:
-                    ivar = hdu.data
-                    break
-            else:
-                print(
-                    "WARNING: Cannot determine the HDU containing variance "
-                    f"data in '{fits_file}'! Using dumb constan variance...",
-                )
-                ivar = np.ones_like(flux)
-        else:
-            ivar = 1 / hdul[var_hdu].data
 
-        if wd_hdu is None:
-            for hdu in hdul:
-                if hdu.name.lower() in ['wd', 'dispersion', 'resolution']:
-                    wd = hdu.data
-                    break
-            else:
-                wd = None
-        else:
-            wd = hdul[wd_hdu].data
+def _read_one(job):
+    """
+    Read a single input file and return plain picklable data.
+
+    This is the worker used to parallelize the reading of the input files:
+    only NumPy arrays and scalars are returned, since Spectrum and Target
+    objects reference C extension state that may not pickle cleanly.
 
-        if flux.shape != ivar.shape:
-            raise ValueError(
-                f"'{fits_file}' - "
-                "Spectral data invalid or corruptede: Flux data shape "
-                "do not match variance data one!"
+    Parameters
+    ----------
+    job : tuple
+        A (index, fits_file, spec_hdu, var_hdu, wd_hdu, use_fitsio) tuple.
+
+    Returns
+    -------
+    data : tuple
+        The data needed by _make_target() to build the actual target.
+
+    """
+    j, fits_file, spec_hdu, var_hdu, wd_hdu, use_fitsio = job
+
+    target_id = f"{j:09}"
+
+    if use_fitsio and HAS_FITSIO:
+        flux, ivar, wd, nanmask, spec_wcs, main_header, spec_id = \
+            _read_spectrum_fitsio(fits_file, spec_hdu, var_hdu, wd_hdu)
+        if spec_id is None:
+            spec_id = target_id
+    else:
+        flux, ivar, wd, nanmask, spec_wcs, main_header, spec_id = \
+            _read_spectrum_astropy(
+                fits_file, target_id, spec_hdu, var_hdu, wd_hdu
             )
 
-        main_header = hdul[0].header
+    if flux.shape != ivar.shape:
+        raise ValueError(
+            f"'{fits_file}' - "
+            "Spectral data invalid or corruptede: Flux data shape "
+            "do not match variance data one!"
+        )
 
-        # NOTE: Wavelenghts must be in Angstrom units
-        pixel = np.arange(len(flux))
-        lam = spec_wcs.pixel_to_world(pixel).Angstrom
+    # NOTE: Wavelenghts must be in Angstrom units
+    lam = _get_wavelengths(spec_wcs, len(flux))
 
-        flux = flux.astype('float32')
+    # No copy is made when the data on disk is already contiguous float32
+    flux = np.ascontiguousarray(flux, dtype=np.float32)
 
-        if nanmask is None:
-            flux_not_nan_mask = ~np.isnan(flux)
-        else:
-            flux_not_nan_mask = ~nanmask
+    if nanmask is None:
+        flux_not_nan_mask = ~np.isnan(flux)
+    else:
+        flux_not_nan_mask = ~nanmask
 
-        lam_mask = np.array([
-            (lam[m_start], lam[m_end])
-            for m_start, m_end in get_mask_intervals(~flux_not_nan_mask)
-        ])
+    lam_mask = np.array([
+        (lam[m_start], lam[m_end])
+        for m_start, m_end in get_mask_intervals(~flux_not_nan_mask)
+    ])
 
-        flux = flux[flux_not_nan_mask]
-        ivar = ivar[flux_not_nan_mask]
-        lam = lam[flux_not_nan_mask]
-        if wd is not None:
-            wd = wd[flux_not_nan_mask]
+    flux = flux[flux_not_nan_mask]
+    ivar = ivar[flux_not_nan_mask]
+    lam = lam[flux_not_nan_mask]
+    if wd is not None:
+        wd = wd[flux_not_nan_mask]
 
-        # If now wavelenght dispersion information is present, then fallback
-        # to a uniform resolution model (i.e. an identiry matrix)
-        if wd is None:
-            R = np.eye(lam.shape[0])
-            R = sparse.dia_matrix(R)
+    try:
+        s_n = main_header['SN']
+    except KeyError:
+        s_n = -1
 
-        try:
-            s_n = main_header['SN']
-        except KeyError:
-            s_n = -1
+    try:
+        s_n_var = main_header['SN_VAR']
+    except KeyError:
+        s_n_var = -1
+
+    return (
+        j, fits_file, target_id, spec_id, lam, flux, ivar, wd, lam_mask,
+        s_n, s_n_var
+    )
 
-        try:
-            s_n_var = main_header['SN_VAR']
-        except KeyError:
-            s_n_var = -1
-
-        rrspec = Spectrum(lam, flux, ivar, R, None)
-        target = Target(target_id, [rrspec])
-        target.input_file = fits_file
-        target.lam_mask = lam_mask
-        target.spec_id = spec_id
-        targets.append(target)
-        targetids.append(target_id)
-        specids.append(spec_id)
-        sn_vals.append(s_n)
-        sn_var_vals.append(s_n_var)
-
-    metatable = Table()
-    metatable['TARGETID'] = targetids
-    metatable['SPECID'] = specids
-    metatable['SN'] = sn_vals
-    metatable['SN_VAR'] = sn_var_vals
+
+# Identity resolution matrices are immutable, so all the spectra with the
+# same number of wavelength bins can share a single instance.
+_IDENTITY_R_CACHE = {}
+
+
+def _get_identity_resolution(n_wave):
+    """
+    Get the identity resolution matrix for a spectrum of n_wave bins.
+
+    The matrices are cached per size, so identically-sized spectra reuse the
+    same object instead of allocating a new one per file.
+
+    Parameters
+    ----------
+    n_wave : int
+        The number of wavelength bins of the spectrum.
+
+    Returns
+    -------
+    R : DiagResolution or scipy.sparse.dia_matrix
+        The identity resolution matrix.
+
+    """
+    try:
+        return _IDENTITY_R_CACHE[n_wave]
+    except KeyError:
+        pass
+
+    # Any per-pixel scaling must be applied in-place to this raw diagonal
+    # buffer *before* wrapping it: a scipy `dia_matrix * k` silently
+    # converts the result to CSR, losing the DIA fast paths and
+    # reallocating O(nnz) index arrays.
+    diag = np.ones((1, n_wave), dtype=np.float32)
+    if HAS_NUMBA:
+        R = DiagResolution(diag, [0], (n_wave, n_wave))
+    else:
+        R = sparse.dia_matrix((diag, [0]), shape=(n_wave, n_wave))
+
+    _IDENTITY_R_CACHE[n_wave] = R
+    return R
+
+
+def _make_target(data):
+    """
+    Build a redrock target from the data returned by _read_one().
+
+    Parameters
+    ----------
+    data : tuple
+        The per-file data returned by _read_one().
+
+    Returns
+    -------
+    target : redrock.targets.Target
+        The target spectrum for which redshift will be computed.
+    meta_row : dict
+        The metadata of the target ('TARGETID', 'SPECID', 'SN' and 'SN_VAR').
+
+    """
+    (
+        j, fits_file, target_id, spec_id, lam, flux, ivar, wd, lam_mask,
+        s_n, s_n_var
+    ) = data
+
+    # If now wavelenght dispersion information is present, then fallback
+    # to a uniform resolution model (i.e. an identiry matrix). Build it
+    # directly in DIA format so only the main diagonal is materialized
+    # instead of a full NxN dense array.
+    if wd is None:
+        R = _get_identity_resolution(lam.shape[0])
+
+    rrspec = Spectrum(lam, flux, ivar, R, None)
+    target = Target(target_id, [rrspec])
+    target.input_file = fits_file
+    target.lam_mask = lam_mask
+    target.spec_id = spec_id
+
+    return target, {
+        'TARGETID': target_id,
+        'SPECID': spec_id,
+        'SN': s_n,
+        'SN_VAR': s_n_var
+    }
+
+
+def read_spectra(spectra_fits_list, spec_hdu=None, var_hdu=None, wd_hdu=None,
+                 use_fitsio=True, nprocs=1):
+    """
+    Read input spectra fits files.
+
+    This is a convenience wrapper around iter_spectra() for consumers, like
+    DistTargetsCopy, that need the full target list at once. The parameters
+    have the same meaning as in iter_spectra().
+
+    Parameters
+    ----------
+    nprocs : int, optional
+        The number of processes used to read the input files. Values greater
+        than one parallelize the reading with a multiprocessing pool, which
+        pays off when dealing with thousands of small files.
+        The default value is 1.
+
+    Returns
+    -------
+    targets : list of redrock.targets.Target
+        The target spectra for which redshift will be computed.
+    metatable : astropy.table.Table
+        A table containing metadata.
+
+    """
+    if nprocs > 1:
+        jobs = [
+            (j, fits_file, spec_hdu, var_hdu, wd_hdu, use_fitsio)
+            for j, fits_file in enumerate(spectra_fits_list)
+        ]
+        # chunksize amortizes the IPC overhead over multiple small files;
+        # the job index is used to preserve a deterministic ordering.
+        results = [None] * len(jobs)
+        with multiprocessing.Pool(nprocs) as pool:
+            for data in pool.imap_unordered(_read_one, jobs, chunksize=8):
+                results[data[0]] = data
+        spectra = (_make_target(data) for data in results)
+    else:
+        spectra = iter_spectra(
+            spectra_fits_list, spec_hdu=spec_hdu, var_hdu=var_hdu,
+            wd_hdu=wd_hdu, use_fitsio=use_fitsio
+        )
+
+    # Pre-size the output lists: the number of targets is known in advance,
+    # so direct index assignment avoids the list-growth reallocations and
+    # works also when the spectra are produced out of order.
+    n_spectra = len(spectra_fits_list)
+    targets = [None] * n_spectra
+    targetids = [None] * n_spectra
+    specids = [None] * n_spectra
+    sn_vals = [None] * n_spectra
+    sn_var_vals = [None] * n_spectra
+    for j, (target, meta_row) in enumerate(spectra):
+        targets[j] = target
+        targetids[j] = meta_row['TARGETID']
+        specids[j] = meta_row['SPECID']
+        sn_vals[j] = meta_row['SN']
+        sn_var_vals[j] = meta_row['SN_VAR']
+
+    metatable = Table({
+        'TARGETID': np.asarray(targetids),
+        'SPECID': np.asarray(specids),
+        'SN': np.asarray(sn_vals),
+        'SN_VAR': np.asarray(sn_var_vals)
+    })
 
     return targets, metatable
 
@@ -428,6 +951,16 @@ def rrspex(options=None, comm=None):
         A dictionary containing the redshift scanning information for each
         target
     """
+    # These redrock imports are heavy (numba compilation, templates
+    # registry): do them lazily so that importing this module just to use
+    # read_spectra or write_zbest stays cheap, and so that spawned
+    # multiprocessing workers do not pay the import cost.
+    from redrock.targets import DistTargetsCopy
+    from redrock.templates import load_dist_templates
+    from redrock.results import write_zscan
+    from redrock.zfind import zfind
+    from redrock.archetypes import All_archetypes
+
     global_start = elapsed(None, "", comm=comm)
     comm_size = 1
     comm_rank = 0
@@ -435,6 +968,11 @@ def rrspex(options=None, comm=None):
         comm_size = comm.size
         comm_rank = comm.rank
 
+    # Configure the logging only on the root process: warnings emitted by
+    # every rank would serialize on stdout/stderr flushes.
+    if comm_rank == 0:
+        logging.basicConfig(level=logging.INFO)
+
     args = __argshandler(options)
 
     # Check arguments - all processes have this, so just check on the first
@@ -462,17 +1000,20 @@ def rrspex(options=None, comm=None):
         if "OMP_NUM_THREADS" in os.environ:
             nthread = int(os.environ["OMP_NUM_THREADS"])
             if nthread != 1:
-                print("WARNING:  {} multiprocesses running, each with "
-                      "{} threads ({} total)".format(
-                          mpprocs, nthread, mpprocs*nthread
-                      ))
-                print("WARNING:  Please ensure this is <= the number of "
-                      "physical cores on the system")
+                log.warning(
+                    "%d multiprocesses running, each with %d threads "
+                    "(%d total)", mpprocs, nthread, mpprocs*nthread
+                )
+                log.warning(
+                    "Please ensure this is <= the number of physical "
+                    "cores on the system"
+                )
         else:
-            print("WARNING:  using multiprocessing, but the OMP_NUM_THREADS")
-            print("WARNING:  environment variable is not set- your system may")
-            print("WARNING:  be oversubscribed.")
-        sys.stdout.flush()
+            log.warning(
+                "using multiprocessing, but the OMP_NUM_THREADS "
+                "environment variable is not set- your system may "
+                "be oversubscribed."
+            )
     elif comm_rank == 0:
         print("Running with {} processes".format(comm_size))
         sys.stdout.flush()
@@ -490,7 +1031,11 @@ def rrspex(options=None, comm=None):
         # that could be changed to work like the DESI write_zbest() function.
         # Each target contains metadata which is propagated to the output zbest
         # table though.
-        targets, meta = read_spectra(args.spectra)
+        # Parallelize the reading only when MPI is disabled, since mixing
+        # MPI and multiprocessing is fragile.
+        targets, meta = read_spectra(
+            args.spectra, nprocs=mpprocs if comm is None else 1
+        )
 
         _ = elapsed(
             start, "Read of {} targets".format(len(targets)), comm=comm
@@ -12,19 +12,90 @@ from __future__ import absolute_import, division, print_function
 import os
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import multiprocessing as mp
 
 from astropy import wcs
 from astropy.io import fits
 from astropy.table import Table
-from astropy.convolution import Gaussian2DKernel, convolve
+from astropy.convolution import Gaussian1DKernel
 
-from scipy.ndimage.morphology import grey_dilation, grey_erosion
+from scipy.ndimage import convolve1d, maximum_filter1d
 
-from .utils import get_pbar, get_hdu
+from .utils import get_pbar, get_hdu, HAS_CUPY
 from .utils import get_spectrum_snr, get_spectrum_snr_emission
 
+if HAS_CUPY:
+    import cupy
+    from .utils import get_spectrum_snr_gpu, get_spectrum_snr_emission_gpu
+
+    _GPU_SNR_FUNCTIONS = {
+        get_spectrum_snr: get_spectrum_snr_gpu,
+        get_spectrum_snr_emission: get_spectrum_snr_emission_gpu,
+    }
+else:
+    _GPU_SNR_FUNCTIONS = {}
+
+try:
+    import numba
+except ImportError:
+    HAS_NUMBA = False
+else:
+    HAS_NUMBA = True
+
+
+if HAS_NUMBA:
+    # Eager compilation with explicit signatures: the cost is paid at
+    # import time (and cached on disk) instead of at the first call
+    @numba.njit(
+        [
+            numba.float32[:, :](numba.float32[:, :], numba.float32[:, :]),
+            numba.float64[:, :](numba.float64[:, :], numba.float64[:, :]),
+        ],
+        parallel=True, nogil=True, cache=True
+    )
+    def _clipped_sum(map_a, map_b):
+        """Compute where(a < 0, 0, a) + where(b < 0, 0, b) in one pass."""
+        out = np.empty_like(map_a)
+        for i in numba.prange(map_a.shape[0]):
+            for j in range(map_a.shape[1]):
+                val_a = map_a[i, j]
+                val_b = map_b[i, j]
+                # NaNs compare False, so they are preserved
+                if val_a < 0:
+                    val_a = 0
+                if val_b < 0:
+                    val_b = 0
+                out[i, j] = val_a + val_b
+        return out
+
+
+def clipped_sum(map_a, map_b):
+    """
+    Sum two maps, clipping negative values to zero.
+
+    NaNs are propagated to the output. When numba is available the
+    clipping and the sum are fused in a single pass over the two maps.
+
+    Parameters
+    ----------
+    map_a : 2D numpy.ndarray
+        The first map.
+    map_b : 2D numpy.ndarray
+        The second map.
+
+    Returns
+    -------
+    total : 2D numpy.ndarray
+        The sum of the two clipped maps.
+
+    """
+    if HAS_NUMBA and map_a.dtype == map_b.dtype and \
+            map_a.dtype in (np.float32, np.float64):
+        return _clipped_sum(map_a, map_b)
+    return np.where(map_a < 0, 0, map_a) + np.where(map_b < 0, 0, map_b)
+
 
 def __argshandler(options=None):
     """
@@ -91,6 +162,12 @@ def __argshandler(options=None):
         help='Set whether to use the inverse of the cube mask.'
     )
 
+    parser.add_argument(
+        '--gpu', action='store_true', default=False,
+        help='Compute the SNR maps on the GPU through the cupy package. '
+        'If cupy is not installed the computation falls back to the CPU.'
+    )
+
     parser.add_argument(
         '--outdir', metavar='DIR', type=str, default=None,
         help='Set the directory where extracted spectra will be outputed. '
@@ -151,37 +228,92 @@ def rebin_slice_2d(data, bin_size_x, bin_size_y=None, rebin_function=np.mean):
     rebinned_h = data.shape[0] // bin_size_y
     rebinned_w = data.shape[1] // bin_size_x
 
-    # Resize data to optimal height and width for rebinning.
-    if data.shape[0] % bin_size_y:
-        rebinned_h += 1
-        optimal_data_height = rebinned_h * bin_size_y
-    else:
-        optimal_data_height = data.shape[0]
+    if not (data.shape[0] % bin_size_y or data.shape[1] % bin_size_x):
+        # The bin sizes divide the image exactly: reduce a 4D view of
+        # the data directly, without any copy or padding.
+        reshaped = data.reshape(rebinned_h, bin_size_y, rebinned_w, bin_size_x)
+        return rebin_function(reshaped, axis=(1, 3))
+
+    # Pad the incomplete border bins with NaNs and use the NaN-aware
+    # version of the rebinning function, so that the padding does not
+    # bias the border bins.
+    rebinned_h += bool(data.shape[0] % bin_size_y)
+    rebinned_w += bool(data.shape[1] % bin_size_x)
+
+    padded = np.pad(
+        np.asarray(data, dtype=float),
+        (
+            (0, rebinned_h * bin_size_y - data.shape[0]),
+            (0, rebinned_w * bin_size_x - data.shape[1])
+        ),
+        mode='constant',
+        constant_values=np.nan
+    )
 
-    if data.shape[1] % bin_size_x:
-        rebinned_w += 1
-        optimal_data_width = rebinned_w * bin_size_x
-    else:
-        optimal_data_width = data.shape[1]
+    nan_functions = {
+        np.mean: np.nanmean,
+        np.median: np.nanmedian,
+        np.sum: np.nansum,
+        np.var: np.nanvar,
+        np.std: np.nanstd,
+    }
+    rebin_function = nan_functions.get(rebin_function, rebin_function)
+
+    reshaped = padded.reshape(rebinned_h, bin_size_y, rebinned_w, bin_size_x)
+    return rebin_function(reshaped, axis=(1, 3))
+
+
+# Gaussian kernels used by smooth_2d_image, keyed by their std. dev.
+# Building a kernel is cheap but the same few widths are requested over
+# and over (once per cube slice or map), so they are cached here.
+_GAUSSIAN_KERNEL_CACHE = {}
+
+
+def smooth_2d_image(image, stddev):
+    """
+    Smooth an image with a gaussian kernel, ignoring NaNs.
+
+    This is a drop-in replacement for astropy.convolution.convolve with
+    a Gaussian2DKernel and preserve_nan=True. A 2D gaussian kernel is
+    separable, so the convolution is done with two 1D passes (one per
+    axis): for a kernel of width k this costs O(2k) operations per
+    pixel instead of the O(k^2) of the full 2D convolution.
+
+    Parameters
+    ----------
+    image : 2D numpy.ndarray
+        The image data.
+    stddev : float
+        Std. Dev. of the smoothing gaussian kernel.
+
+    Returns
+    -------
+    smoothed : 2D numpy.ndarray
+        The smoothed image. Pixels that are NaN in the input are NaN
+        also in the output.
 
-    # Padding with original array in order to reshape it correctly
-    zeros = np.zeros((optimal_data_height, optimal_data_width))
-    masked_data = np.ma.array(zeros, mask=zeros == 0)
-    masked_data.mask[:data.shape[0], :data.shape[1]] = False
-    masked_data[:data.shape[0], :data.shape[1]] = data
+    """
+    try:
+        kernel = _GAUSSIAN_KERNEL_CACHE[stddev]
+    except KeyError:
+        kernel = Gaussian1DKernel(stddev=stddev).array
+        _GAUSSIAN_KERNEL_CACHE[stddev] = kernel
 
-    # Reshape the array
-    reshaped = masked_data.reshape(
-        rebinned_h, bin_size_y,
-        rebinned_w, bin_size_x
-    ).transpose(0, 2, 1, 3)
+    def separable_convolve(data):
+        partial = convolve1d(data, kernel, axis=0, mode='constant')
+        return convolve1d(partial, kernel, axis=1, mode='constant')
 
-    reshaped = reshaped.reshape(rebinned_h, rebinned_w, bin_size_y*bin_size_x)
+    finite = np.isfinite(image)
+    smoothed = separable_convolve(np.where(finite, image, 0))
 
-    # Do actual rebinning
-    rebinned = rebin_function(reshaped, axis=-1)
+    # Renormalize using the local weight of the valid pixels, like
+    # nan_treatment='interpolate' does in astropy convolve
+    norm = separable_convolve(finite.astype(float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed /= norm
 
-    return rebinned
+    smoothed[~finite] = np.nan
+    return smoothed
 
 
 def get_sn_single_slice(cube_slice, cube_slice_var=None, rebin_size=2,
@@ -220,14 +352,7 @@ def get_sn_single_slice(cube_slice, cube_slice_var=None, rebin_size=2,
     """
     # Compute the SN ratio for each pixel in the slice.
     # First of all, smooth the image using a 2D gaussian kernel.
-    kernel = Gaussian2DKernel(x_stddev=kernel_width)  # x_stddev = y_stddev
-    smoothed_slice = convolve(
-        cube_slice,
-        kernel,
-        nan_treatment='fill',
-        fill_value='-1',
-        preserve_nan=True
-    )
+    smoothed_slice = smooth_2d_image(cube_slice, kernel_width)
 
     bin_size = 2 * rebin_size + 1
 
@@ -241,8 +366,11 @@ def get_sn_single_slice(cube_slice, cube_slice_var=None, rebin_size=2,
             noise_image, bin_size, rebin_function=np.var
         )
 
-        # Rescale back to original size
-        cube_slice_var = np.kron(rebinned_var, np.ones((bin_size, bin_size)))
+        # Rescale back to original size. np.repeat just tiles each
+        # rebinned pixel, while np.kron would also multiply every pixel
+        # by every element of the ones block.
+        cube_slice_var = rebinned_var.repeat(bin_size, axis=0)
+        cube_slice_var = cube_slice_var.repeat(bin_size, axis=1)
         cube_slice_var = cube_slice_var[
             :cube_slice.shape[0],
             :cube_slice.shape[1]
@@ -253,6 +381,42 @@ def get_sn_single_slice(cube_slice, cube_slice_var=None, rebin_size=2,
     return sn_map
 
 
+def _read_cube_data(hdu, dtype=None, chunk_size=64):
+    """
+    Read the data of a cube HDU in wavelength chunks.
+
+    Accessing the data through hdu.section reads and scales one block
+    of wavelength planes at a time, so the peak memory overhead of the
+    load is bound to a single chunk instead of a second full copy of
+    the cube.
+
+    Parameters
+    ----------
+    hdu : astropy.fits.ImageHDU
+        The HDU containing the cube data.
+    dtype : numpy dtype, optional
+        The dtype of the output array. If None, the native dtype of the
+        data is used. The default is None.
+    chunk_size : int, optional
+        Number of wavelength planes read at once. The default is 64.
+
+    Returns
+    -------
+    data : 3D numpy.ndarray
+        The cube data.
+
+    """
+    data = None
+    for start in range(0, hdu.shape[0], chunk_size):
+        chunk = hdu.section[start:start + chunk_size]
+        if dtype is not None:
+            chunk = np.asarray(chunk, dtype=dtype)
+        if data is None:
+            data = np.empty(hdu.shape, dtype=chunk.dtype)
+        data[start:start + chunk_size] = chunk
+    return data
+
+
 def get_snr_spaxels(data_hdu, var_hdu=None, mask_hdu=None, inverse_mask=False,
                     snr_function=get_spectrum_snr):
     """
@@ -269,62 +433,161 @@ def get_snr_spaxels(data_hdu, var_hdu=None, mask_hdu=None, inverse_mask=False,
 
     Returns
     -------
-    snr_map : TYPE
-        DESCRIPTION.
+    snr_map : 2D numpy.ndarray
+        The SNR map of the datacube.
 
     """
+    return get_snr_spaxels_multi(
+        data_hdu, var_hdu, mask_hdu, inverse_mask,
+        snr_functions=[snr_function]
+    )[0]
+
+
+def _compute_snr_blocked(snr_function, flux_2d, ivar_2d):
+    """
+    Run a SNR estimator on row blocks of the spaxel stack in parallel.
+
+    The heavy numpy/scipy reductions release the GIL, so plain threads
+    are enough to keep the cores busy without the pickling and memory
+    duplication of a process pool: each thread just works on a
+    contiguous block of rows of the shared arrays.
+    """
+    n_blocks = min(os.cpu_count() or 1, flux_2d.shape[0])
+    if n_blocks <= 1:
+        return snr_function(flux_2d, axis=-1, ivar=ivar_2d)
+
+    flux_blocks = np.array_split(flux_2d, n_blocks, axis=0)
+    if ivar_2d is not None:
+        ivar_blocks = np.array_split(ivar_2d, n_blocks, axis=0)
+    else:
+        ivar_blocks = [None] * n_blocks
+
+    def compute_block(flux_block, ivar_block):
+        return np.asarray(
+            snr_function(flux_block, axis=-1, ivar=ivar_block)
+        )
+
+    with ThreadPoolExecutor(max_workers=n_blocks) as pool:
+        blocks = list(pool.map(compute_block, flux_blocks, ivar_blocks))
+
+    return np.concatenate(blocks)
+
+
+def get_snr_spaxels_multi(data_hdu, var_hdu=None, mask_hdu=None,
+                          inverse_mask=False,
+                          snr_functions=(get_spectrum_snr,
+                                         get_spectrum_snr_emission),
+                          use_gpu=False):
+    """
+    Get multiple SNR maps of a spectral datacube in a single pass.
+
+    The cube data is read, masked and reshaped only once and every
+    requested SNR estimator is run on the same in-memory views, so the
+    cube is traversed once instead of once per map.
+
+    Parameters
+    ----------
+    data_hdu : astropy.fits.ImageHDU
+        The HDU containing spectral data.
+    var_hdu : astropy.fits.ImageHDU, optional
+        The HDU containing the variance of the spectral data.
+        The default is None.
+    mask_hdu : astropy.fits.ImageHDU, optional
+        The HDU containing data qaulity mask. The default is None.
+    inverse_mask : bool, optional
+        Wether to use the inverse of the mask. The default is False.
+    snr_functions : list of functions, optional
+        The SNR estimators to run on the cube. They must accept the
+        axis and ivar keyword arguments, like get_spectrum_snr does.
+        The default is (get_spectrum_snr, get_spectrum_snr_emission).
+    use_gpu : bool, optional
+        Whether to run the estimators on the GPU through cupy. If cupy
+        is not available, or an estimator has no GPU counterpart, the
+        computation falls back to the CPU. The default is False.
+
+    Returns
+    -------
+    snr_maps : list of 2D numpy.ndarray
+        One SNR map per input function.
+
+    """
+    # Single precision is plenty for a detection map and halves both
+    # the memory footprint of the cube and the bandwidth used by the
+    # reductions.
+    cube_data = _read_cube_data(data_hdu, dtype=np.float32)
 
     if mask_hdu is None:
-        cube_mask = np.isnan(data_hdu.data)
+        cube_mask = np.isnan(cube_data)
     else:
         cube_mask = mask_hdu.data != 0 if inverse_mask else mask_hdu.data == 0
+        # Encode masked values as NaNs: the SNR estimators mask NaNs
+        # internally and a plain array survives the relayout below,
+        # while a MaskedArray mask would not.
+        cube_data[cube_mask] = np.nan
+
+    n_wave = cube_data.shape[0]
+    height, width = cube_data.shape[1], cube_data.shape[2]
+
+    # Rearrange the cube so that each spaxel spectrum is a contiguous
+    # row of a (nspaxels, nlambda) array: the SNR estimators reduce
+    # along the wavelength axis and on this layout the reductions run
+    # on unit strides, instead of jumping ny*nx elements between two
+    # samples of the same spectrum.
+    flux_2d = np.ascontiguousarray(np.moveaxis(cube_data, 0, -1))
+    flux_2d = flux_2d.reshape(-1, n_wave)
+    del cube_data
 
     if var_hdu is not None:
-        cube_var = np.ma.array(
-            var_hdu.data, mask=cube_mask & np.isnan(var_hdu.data)
-        )
+        var_data = _read_cube_data(var_hdu, dtype=np.float32)
+        # No need to encode the mask here: the positions masked in the
+        # variance (cube_mask & isnan) are NaN by construction.
+        var_2d = np.ascontiguousarray(np.moveaxis(var_data, 0, -1))
+        var_2d = var_2d.reshape(-1, n_wave)
+        del var_data
     else:
-        cube_var = None
-
-    cube_flux = np.ma.array(data_hdu.data, mask=cube_mask)
-
-    snr_map = np.zeros((cube_flux.shape[1], cube_flux.shape[2]))
-
-    i = 0
-    footprint_size = cube_flux.shape[1] * cube_flux.shape[2]
-    results = {}
-    # Generating jobs...
-    with mp.Pool() as my_pool:
-        for h in range(cube_flux.shape[1]):
-            for k in range(cube_flux.shape[2]):
-                i += 1
-                if (i % 10) == 0:
-                    progress = 0.5 * i / footprint_size
-                    sys.stderr.write(
-                        f"\r{get_pbar(progress)} {progress:.2%}\r"
-                    )
-                    sys.stderr.flush()
-                # The snr of a single spaxel
-                # snr_map[h, k] = get_spectrum_snr(cube_flux[:, h, k])
-                results[h, k] = my_pool.apply_async(
-                    snr_function,
-                    (
-                        cube_flux[:, h, k],
-                        cube_var[:, h, k] if cube_var is not None else None
-                    ),
-                )
+        var_2d = None
+
+    if use_gpu and not all(f in _GPU_SNR_FUNCTIONS for f in snr_functions):
+        if not HAS_CUPY:
+            print(
+                "WARNING: cupy is not installed, computing the SNR maps "
+                "on the CPU...",
+                file=sys.stderr
+            )
+        else:
+            print(
+                "WARNING: some SNR estimators have no GPU counterpart, "
+                "computing the SNR maps on the CPU...",
+                file=sys.stderr
+            )
+        use_gpu = False
+
+    ivar_2d = None
+    if use_gpu:
+        # One transfer to the device, shared by all the estimators
+        flux_2d = cupy.asarray(flux_2d)
+        if var_2d is not None:
+            var_2d = cupy.asarray(var_2d)
+    elif var_2d is not None:
+        # The estimators only use the variance through its reciprocal:
+        # invert it once here and share the result among them, instead
+        # of paying one full-stack division per estimator
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ivar_2d = 1.0 / var_2d
+
+    snr_maps = []
+    for snr_function in snr_functions:
+        if use_gpu:
+            gpu_function = _GPU_SNR_FUNCTIONS[snr_function]
+            snr_spaxels = cupy.asnumpy(gpu_function(flux_2d, var_2d, axis=-1))
+        else:
+            snr_spaxels = _compute_snr_blocked(snr_function, flux_2d, ivar_2d)
+        # The estimators encode invalid spaxels as NaNs, no masked
+        # arrays involved
+        snr_map = np.asarray(snr_spaxels)
+        snr_maps.append(snr_map.reshape(height, width).astype(np.float32))
 
-        for i, (pos, val) in enumerate(results.items()):
-            if (i % 10) == 0:
-                progress = 0.5 + 0.5 * i / footprint_size
-                sys.stderr.write(
-                    f"\r{get_pbar(progress)} {progress:.2%}\r"
-                )
-                sys.stderr.flush()
-            val.wait()
-            snr_map[pos] = val.get()
-    print("")
-    return snr_map
+    return snr_maps
 
 
 def get_local_maxima(image, threshold=0, smoothing_factor=1):
@@ -348,12 +611,7 @@ def get_local_maxima(image, threshold=0, smoothing_factor=1):
     hh, ww = image.shape
     p_map = np.zeros_like(image)
 
-    smoothing_kernel = Gaussian2DKernel(x_stddev=1)
-    im_smooth = convolve(
-        image,
-        smoothing_kernel,
-        preserve_nan=True
-    )
+    im_smooth = smooth_2d_image(image, 1)
 
     for h in range(1, hh-1):
         for k in range(1, ww-1):
@@ -365,15 +623,15 @@ def get_local_maxima(image, threshold=0, smoothing_factor=1):
             ):
                 p_map[h, k] += 1
 
-    peaks = np.argwhere(p_map > 0)
+    # Work with flat indices: a single index array instead of one per
+    # coordinate, and the row/column positions are computed with one
+    # divmod only for the peaks that survive the threshold
+    flat_peaks = np.flatnonzero(p_map > 0)
+    peak_values = im_smooth.ravel()[flat_peaks]
 
-    valid_peaks = np.array(
-        [
-            (x[0], x[1], im_smooth[x[0], x[1]]) for x in peaks
-            if not np.isnan(im_smooth[x[0], x[1]]) and
-            im_smooth[x[0], x[1]] > threshold
-        ]
-    )
+    valid = ~np.isnan(peak_values) & (peak_values > threshold)
+    peaks_y, peaks_x = np.divmod(flat_peaks[valid], im_smooth.shape[1])
+    valid_peaks = np.column_stack((peaks_y, peaks_x, peak_values[valid]))
 
     tbl = Table(data=valid_peaks, names=['Y_IMAGE', 'X_IMAGE', 'SNR'])
 
@@ -405,33 +663,26 @@ def get_dilation_maxima(image, box_sizes=[3, 5], threshold=0,
     if not box_sizes:
         box_sizes = [3, 5]
 
-    smoothing_kernel = Gaussian2DKernel(x_stddev=1)
-    im_smooth = convolve(
-        image,
-        smoothing_kernel,
-        preserve_nan=True
-    )
-
-    dilated = [
-        grey_dilation(im_smooth, size=x) for x in box_sizes
-    ]
+    im_smooth = smooth_2d_image(image, 1)
 
-    mask = np.ones_like(im_smooth, dtype=bool)
+    # A pixel equal to the dilation of the image with the largest box
+    # is also equal to the dilation with any smaller box, so a single
+    # filter with size max(box_sizes) is enough. The box maximum is
+    # separable, hence the two 1D passes.
+    dilated = maximum_filter1d(im_smooth, max(box_sizes), axis=0)
+    dilated = maximum_filter1d(dilated, max(box_sizes), axis=1)
 
-    for d_img in dilated:
-        mask &= im_smooth == d_img
+    mask = im_smooth == dilated
 
     # TODO: What happens if we have a region of pixels of euqal values?
     #       In this case we should find the center of mass of the region?
-    peaks = np.argwhere(mask)
+    # Work with flat indices, see get_local_maxima
+    flat_peaks = np.flatnonzero(mask)
+    peak_values = im_smooth.ravel()[flat_peaks]
 
-    valid_peaks = np.array(
-        [
-            (x[0], x[1], im_smooth[x[0], x[1]]) for x in peaks
-            if not np.isnan(im_smooth[x[0], x[1]]) and
-            im_smooth[x[0], x[1]] > threshold
-        ]
-    )
+    valid = ~np.isnan(peak_values) & (peak_values > threshold)
+    peaks_y, peaks_x = np.divmod(flat_peaks[valid], im_smooth.shape[1])
+    valid_peaks = np.column_stack((peaks_y, peaks_x, peak_values[valid]))
 
     tbl = Table(data=valid_peaks, names=['Y_IMAGE', 'X_IMAGE', 'SNR'])
 
@@ -497,12 +748,18 @@ def source_clustering(sources_table, data_hdu, var_hdu=None, mask_hdu=None,
     source_map = -1 * np.ones((cube_flux.shape[1], cube_flux.shape[2]))
     source_prob = np.ones((cube_flux.shape[1], cube_flux.shape[2]))
 
+    # Refresh the progress bar at most ~200 times in total: writing and
+    # flushing the terminal at every iteration costs more than the
+    # bookkeeping of a small source.
+    update_every = max(1, len(sources_table) // 200)
+
     for sid, source in enumerate(sources_table):
-        progress = sid / len(sources_table)
-        sys.stderr.write(
-            f"\r{get_pbar(progress)} {progress:.2%}\r"
-        )
-        sys.stderr.flush()
+        if sid % update_every == 0:
+            progress = sid / len(sources_table)
+            print(
+                f"{get_pbar(progress)} {progress:.2%}",
+                end='\r', file=sys.stderr, flush=True
+            )
 
         source_x = int(source['X_IMAGE'])
         source_y = int(source['Y_IMAGE'])
@@ -535,12 +792,12 @@ def source_clustering(sources_table, data_hdu, var_hdu=None, mask_hdu=None,
         pixels.sort(key=lambda tup: tup[2])
 
         for j, (new_sp_y, new_sp_x, d) in enumerate(pixels):
-            progress = (sid + j/len(pixels)) / len(sources_table)
-            if j % 10 == 0:
-                sys.stderr.write(
-                    f"\r{get_pbar(progress)} {progress:.2%}\r"
+            if sid % update_every == 0 and j % 10 == 0:
+                progress = (sid + j/len(pixels)) / len(sources_table)
+                print(
+                    f"{get_pbar(progress)} {progress:.2%}",
+                    end='\r', file=sys.stderr, flush=True
                 )
-                sys.stderr.flush()
             # Add a new pixel to source_map
 
             if not has_a_neighbour(source_map, new_sp_y, new_sp_x):
@@ -599,7 +856,11 @@ def detect_from_cube(options=None):
     basename_with_ext = os.path.basename(args.input_cube[0])
     basename = os.path.splitext(basename_with_ext)[0]
 
-    hdl = fits.open(args.input_cube[0])
+    # memmap avoids reading the whole cube in memory at open time:
+    # the actual data is pulled in wavelength chunks through
+    # hdu.section by _read_cube_data
+    hdl = fits.open(args.input_cube[0], mode='readonly', memmap=True,
+                    lazy_load_hdus=True)
 
     spec_hdu = get_hdu(
         hdl,
@@ -641,38 +902,25 @@ def detect_from_cube(options=None):
     hdu.writeto(f"{basename}_snr_map.fits", overwrite=True)
     """
 
-    print("\nComputing SNR of emission fearures...", file=sys.stderr)
-    snr_map_em = get_snr_spaxels(
+    print(
+        "\nComputing SNR of the continuum and of emission fearures...",
+        file=sys.stderr
+    )
+    snr_map_ct, snr_map_em = get_snr_spaxels_multi(
         spec_hdu, var_hdu, mask_hdu,
-        snr_function=get_spectrum_snr_emission
+        snr_functions=(get_spectrum_snr, get_spectrum_snr_emission),
+        use_gpu=args.gpu
     )
+
     hdu = fits.PrimaryHDU(data=snr_map_em, header=celestial_wcs.to_header())
     hdu.writeto(f"{basename}_snr_map_em.fits", overwrite=True)
 
-    print("\nComputing SNR of the continuum...", file=sys.stderr)
-    snr_map_ct = get_snr_spaxels(
-        spec_hdu, var_hdu, mask_hdu,
-        snr_function=get_spectrum_snr
-    )
     hdu = fits.PrimaryHDU(data=snr_map_ct, header=celestial_wcs.to_header())
     hdu.writeto(f"{basename}_snr_map_cont.fits", overwrite=True)
 
-    smoothing_kernel = Gaussian2DKernel(x_stddev=1.5)
-
-    snr_map_em_smooth = convolve(
-        snr_map_em,
-        smoothing_kernel,
-        preserve_nan=True
-    )
-    snr_map_ct_smooth = convolve(
-        snr_map_ct,
-        smoothing_kernel,
-        preserve_nan=True
-    )
-
-    snr_map_em_smooth[snr_map_em_smooth < 0] = 0
-    snr_map_ct_smooth[snr_map_ct_smooth < 0] = 0
+    snr_map_em_smooth = smooth_2d_image(snr_map_em, 1.5)
+    snr_map_ct_smooth = smooth_2d_image(snr_map_ct, 1.5)
 
-    snr_map = snr_map_em_smooth + snr_map_ct_smooth
+    snr_map = clipped_sum(snr_map_em_smooth, snr_map_ct_smooth)
     hdu = fits.PrimaryHDU(data=snr_map, header=celestial_wcs.to_header())
     hdu.writeto(f"{basename}_snr_map_total.fits", overwrite=True)
@@ -12,9 +12,11 @@ from __future__ import absolute_import, division, print_function
 import os
 import sys
 import argparse
+import threading
 
 import numpy as np
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy.signal import savgol_filter
 from astropy import wcs
@@ -40,6 +42,110 @@ except ImportError:
 else:
     HAS_RR = True
 
+try:
+    import numba
+except ImportError:
+    HAS_NUMBA = False
+else:
+    HAS_NUMBA = True
+
+
+if HAS_NUMBA:
+    @numba.njit(
+        numba.boolean[:, :](
+            numba.float64[:], numba.float64[:], numba.float64,
+            numba.float64, numba.float64, numba.float64, numba.float64
+        ),
+        nogil=True,
+        fastmath=True,
+        cache=True
+    )
+    def _ellipse_mask(xx_tr, yy_tr, cos_t, sin_t, inv_a, inv_b, threshold):
+        """
+        Evaluate an elliptical aperture on a tile of pixel coordinates.
+
+        Fused version of the ellipse condition used by the kron_ellipse
+        extraction mode: it produces the boolean mask directly, without
+        the intermediate rotated-coordinate arrays.
+        """
+        tile_h = yy_tr.shape[0]
+        tile_w = xx_tr.shape[0]
+        mask = np.empty((tile_h, tile_w), dtype=np.bool_)
+        for i in range(tile_h):
+            for j in range(tile_w):
+                x_over_a = (xx_tr[j]*cos_t + yy_tr[i]*sin_t) * inv_a
+                y_over_b = (xx_tr[j]*sin_t - yy_tr[i]*cos_t) * inv_b
+                mask[i, j] = (x_over_a*x_over_a + y_over_b*y_over_b) \
+                    < threshold
+        return mask
+
+    _EXTRACT_SPECTRUM_SIGNATURES = [
+        numba.types.UniTuple(numba.float64[:], 2)(
+            numba.float32[:, :, :], numba.float32[:, :, :],
+            numba.boolean[:, :]
+        ),
+        numba.types.UniTuple(numba.float64[:], 2)(
+            numba.float64[:, :, :], numba.float64[:, :, :],
+            numba.boolean[:, :]
+        ),
+    ]
+
+    @numba.njit(_EXTRACT_SPECTRUM_SIGNATURES, nogil=True, cache=True)
+    def _extract_spectrum(flux, var, mask):
+        """
+        Compute the spectrum and its variance of a masked cube tile.
+
+        Fused equivalent of get_spectrum() for the case where the
+        variance is available: a single traversal of the tile computes
+        both the inverse-variance weighted spectrum (rescaled by the
+        number of pixels in the aperture) and the summed variance,
+        without gathering the masked spaxels into intermediate copies.
+        """
+        nwave = flux.shape[0]
+        tile_h = mask.shape[0]
+        tile_w = mask.shape[1]
+
+        spectrum = np.empty(nwave, dtype=np.float64)
+        spectrum_var = np.empty(nwave, dtype=np.float64)
+
+        npix = 0
+        for y in range(tile_h):
+            for x in range(tile_w):
+                if mask[y, x]:
+                    npix += 1
+
+        for k in range(nwave):
+            num = 0.0
+            den = 0.0
+            var_sum = 0.0
+            has_num = False
+            has_var = False
+            for y in range(tile_h):
+                for x in range(tile_w):
+                    if not mask[y, x]:
+                        continue
+                    v = var[k, y, x]
+                    if np.isnan(v):
+                        continue
+                    has_var = True
+                    var_sum += v
+                    if v != 0:
+                        w = 1.0 / v
+                        den += w
+                        f = flux[k, y, x]
+                        if not np.isnan(f):
+                            num += f * w
+                            has_num = True
+
+            if has_num and den != 0:
+                spectrum[k] = num / den * npix
+            else:
+                spectrum[k] = np.nan
+
+            spectrum_var[k] = var_sum if has_var else np.nan
+
+        return spectrum, spectrum_var
+
 
 def __argshandler(options=None):
     """
@@ -114,6 +220,22 @@ def __argshandler(options=None):
         'spectrum having a SN ratio lower than threshold will be ignored.'
     )
 
+    parser.add_argument(
+        '--min-pixels', metavar='MIN_PIXELS', type=int, default=1,
+        help='Set the minimum number of valid pixels an aperture must '
+        'contain: objects with a smaller footprint are skipped before any '
+        'data is read from the cube. '
+        'The default value is %(metavar)s=%(default)s.'
+    )
+
+    parser.add_argument(
+        '--boss', action='store_true', default=False,
+        help='Write all the extracted spectra into a single BOSS '
+        'spPlate-like fits file instead of writing one small fits file per '
+        'object. If redshift estimation is requested, the individual files '
+        'are written anyway since they are needed by the redshift stage.'
+    )
+
     parser.add_argument(
         '--no-nans', action='store_true', default=False,
         help="This option tells the program to replace eventual NaNs in the"
@@ -408,8 +530,39 @@ def get_spplate_fits(cube_header, spec_header, obj_ids, spec_data,
     return hdul
 
 
+def get_spsingle_header_template(spec_hdu_header):
+    """
+    Build the header template for the extracted spectra.
+
+    The returned header contains the cards that are common to the
+    spectrum and variance extensions of every extracted spectrum, so it
+    can be built once per cube and reused for all the objects.
+
+    Parameters
+    ----------
+    spec_hdu_header : astropy.io.fits.Header object
+        Header of the HDU of the original cube containing the spectral data.
+
+    Returns
+    -------
+    header_template : astropy.io.fits.Header object
+        The header template.
+
+    """
+    header_template = fits.Header()
+    header_template['BUNIT'] = spec_hdu_header['BUNIT']
+    header_template["OBJECT"] = spec_hdu_header["OBJECT"]
+    header_template["CUNIT1"] = spec_hdu_header["CUNIT3"]
+    header_template["CTYPE1"] = spec_hdu_header["CTYPE3"]
+    header_template["CRPIX1"] = spec_hdu_header["CRPIX3"]
+    header_template["CRVAL1"] = spec_hdu_header["CRVAL3"]
+    header_template["CDELT1"] = spec_hdu_header["CD3_3"]
+    return header_template
+
+
 def get_spsingle_fits(main_header, spec_wcs_header, obj_spectrum,
-                      spec_hdu_header, obj_spectrum_var=None, no_nans=False):
+                      spec_hdu_header, obj_spectrum_var=None, no_nans=False,
+                      header_template=None, var_fill_value=None):
     """
     Generate a fits containing the spectral data.
 
@@ -432,6 +585,13 @@ def get_spsingle_fits(main_header, spec_wcs_header, obj_spectrum,
         If true, nan values in the spectrum are replaced by a linear
         interpolation. In this case an additional extension is added to the
         fits file, containing a mask for identifying the previously bax pixels.
+    header_template : astropy.io.fits.Header object, optional
+        The header template generated by get_spsingle_header_template().
+        If None, a new template is built from spec_hdu_header.
+    var_fill_value : float, optional
+        The variance assigned to the bad pixels when no_nans is True.
+        If None, a value is computed from the variance of the spectrum
+        itself.
 
     Returns
     -------
@@ -439,9 +599,6 @@ def get_spsingle_fits(main_header, spec_wcs_header, obj_spectrum,
         The fits HDUL containing the extracted spectra.
 
     """
-    my_time = Time.now()
-    my_time.format = 'isot'
-
     if isinstance(obj_spectrum, np.ma.MaskedArray):
         obj_spectrum = obj_spectrum.filled(np.nan)
 
@@ -460,22 +617,18 @@ def get_spsingle_fits(main_header, spec_wcs_header, obj_spectrum,
                 file=sys.stderr
             )
 
-    spec_header = fits.Header()
-    spec_header['BUNIT'] = spec_hdu_header['BUNIT']
-    spec_header["OBJECT"] = spec_hdu_header["OBJECT"]
-    spec_header["CUNIT1"] = spec_hdu_header["CUNIT3"]
-    spec_header["CTYPE1"] = spec_hdu_header["CTYPE3"]
-    spec_header["OBJECT"] = spec_hdu_header["OBJECT"]
-    spec_header["CRPIX1"] = spec_hdu_header["CRPIX3"]
-    spec_header["CRVAL1"] = spec_hdu_header["CRVAL3"]
-    spec_header["CDELT1"] = spec_hdu_header["CD3_3"]
-    spec_header["OBJECT"] = spec_hdu_header["OBJECT"]
+    if header_template is None:
+        header_template = get_spsingle_header_template(spec_hdu_header)
+
+    spec_header = header_template.copy()
 
     if no_nans:
         nanmask = np.isnan(obj_spectrum)
-        obj_spectrum[nanmask] = 0
+        obj_spectrum = np.nan_to_num(obj_spectrum, copy=False, nan=0.0)
         if obj_spectrum_var is not None:
-            obj_spectrum_var[nanmask] = np.nanmax(obj_spectrum_var) * 100.0
+            if var_fill_value is None:
+                var_fill_value = np.nanmax(obj_spectrum_var) * 100.0
+            obj_spectrum_var[nanmask] = var_fill_value
     else:
         nanmask = None
 
@@ -489,16 +642,7 @@ def get_spsingle_fits(main_header, spec_wcs_header, obj_spectrum,
     ]
 
     if obj_spectrum_var is not None:
-        var_header = fits.Header()
-        var_header['BUNIT'] = spec_hdu_header['BUNIT']
-        var_header["OBJECT"] = spec_hdu_header["OBJECT"]
-        var_header["CUNIT1"] = spec_hdu_header["CUNIT3"]
-        var_header["CTYPE1"] = spec_hdu_header["CTYPE3"]
-        var_header["OBJECT"] = spec_hdu_header["OBJECT"]
-        var_header["CRPIX1"] = spec_hdu_header["CRPIX3"]
-        var_header["CRVAL1"] = spec_hdu_header["CRVAL3"]
-        var_header["CDELT1"] = spec_hdu_header["CD3_3"]
-        var_header["OBJECT"] = spec_hdu_header["OBJECT"]
+        var_header = header_template.copy()
         hdu_list.append(
             fits.ImageHDU(
                 data=obj_spectrum_var,
@@ -669,7 +813,12 @@ def spex(options=None):
 
     basename = os.path.splitext(basename_with_ext)[0]
 
-    hdl = fits.open(args.input_cube[0])
+    hdl = fits.open(
+        args.input_cube[0],
+        mode='readonly',
+        memmap=True,
+        lazy_load_hdus=True
+    )
 
     spec_hdu = get_hdu(
         hdl,
@@ -750,20 +899,19 @@ def spex(options=None):
     sources.add_column(obj_x, name='CUBE_X_IMAGE')
     sources.add_column(obj_y, name='CUBE_Y_IMAGE')
 
-    img_height, img_width = spec_hdu.data.shape[1], spec_hdu.data.shape[2]
-
-    yy, xx = np.meshgrid(
-        np.arange(img_height),
-        np.arange(img_width),
-        indexing='ij'
-    )
+    img_height, img_width = spec_hdu.shape[1], spec_hdu.shape[2]
 
     if args.check_images:
-        extracted_data = np.zeros((img_height, img_width))
+        # Counts of extracted pixels: a signed integer accumulator is
+        # enough (anulus pixels are subtracted, so it can go negative)
+        # and is four times smaller than the float64 default
+        extracted_data = np.zeros((img_height, img_width), dtype=np.int32)
 
     # Chech if there is a footprint mask in the cube
     if mask_hdu is not None:
-        cube_footprint = mask_hdu.data.prod(axis=0) == 0
+        # Short-circuiting any() is cheaper than a full product and
+        # cannot overflow for integer masks
+        cube_footprint = np.any(mask_hdu.data == 0, axis=0)
         if args.invert_mask:
             cube_footprint = ~cube_footprint
     else:
@@ -791,6 +939,67 @@ def spex(options=None):
 
     print(f"Extracting spectra with strategy '{mode}'", file=sys.stderr)
 
+    # Check wheter to use anuli to compute background
+    anulus_str = args.anulus_size.lower().strip().split(',')
+
+    anulus_r_in = None
+    anulus_r_out = None
+    if anulus_str and len(anulus_str) == 2:
+        try:
+            anulus_r1 = float(anulus_str[0])
+            anulus_r2 = float(anulus_str[1])
+        except ValueError:
+            pass
+        else:
+            anulus_r_in = min(anulus_r1, anulus_r2)
+            anulus_r_out = max(anulus_r1, anulus_r2)
+
+    # The aperture and anulus radii are in arcseconds: convert them to
+    # pixels once and square them, since the masks are built from
+    # squared pixel distances (the old code compared the squared
+    # distance against a non-squared radius, shrinking the apertures).
+    aperture_r_pix = args.aperture_size / cube_pixelscale
+    aperture_r_pix2 = aperture_r_pix ** 2
+    if anulus_r_in is not None and anulus_r_out is not None:
+        anulus_r_in_pix2 = (anulus_r_in / cube_pixelscale) ** 2
+        anulus_r_out_pix2 = (anulus_r_out / cube_pixelscale) ** 2
+
+    # Discard the sources whose aperture cannot intersect the cube
+    # before doing any other per-source work: the margin is the largest
+    # bounding-box radius an aperture can have in this mode.
+    if mode == 'kron_ellipse':
+        bbox_margin = np.nanmax(
+            np.asarray(sources[args.key_a], dtype=float)
+            / np.sqrt(np.asarray(sources[args.key_kron], dtype=float))
+        )
+    elif mode == 'kron_circular':
+        bbox_margin = np.nanmax(
+            np.asarray(sources[args.key_kron], dtype=float)
+            * np.asarray(sources[args.key_b], dtype=float)
+            / np.asarray(sources[args.key_a], dtype=float)
+        )
+    else:
+        bbox_margin = aperture_r_pix
+        if anulus_r_in and anulus_r_out:
+            bbox_margin = max(bbox_margin, anulus_r_out / cube_pixelscale)
+
+    if not np.isfinite(bbox_margin):
+        bbox_margin = 0.0
+
+    inside_frame = (sources['CUBE_X_IMAGE'] >= -bbox_margin)
+    inside_frame &= sources['CUBE_X_IMAGE'] < (img_width + bbox_margin)
+    inside_frame &= sources['CUBE_Y_IMAGE'] >= -bbox_margin
+    inside_frame &= sources['CUBE_Y_IMAGE'] < (img_height + bbox_margin)
+    inside_frame = np.asarray(inside_frame, dtype=bool)
+
+    if not np.all(inside_frame):
+        print(
+            f"WARNING: discarding {np.sum(~inside_frame)} sources that "
+            "are outside the cube...",
+            file=sys.stderr
+        )
+        sources = sources[inside_frame]
+
     n_objects = len(sources)
     if args.nspectra:
         n_objects = int(args.nspectra)
@@ -822,21 +1031,6 @@ def spex(options=None):
 
     valid_sources_mask = np.zeros(len(sources), dtype=bool)
 
-    # Check wheter to use anuli to compute background
-    anulus_str = args.anulus_size.lower().strip().split(',')
-
-    anulus_r_in = None
-    anulus_r_out = None
-    if anulus_str and len(anulus_str) == 2:
-        try:
-            anulus_r1 = float(anulus_str[0])
-            anulus_r2 = float(anulus_str[1])
-        except ValueError:
-            pass
-        else:
-            anulus_r_in = min(anulus_r1, anulus_r2)
-            anulus_r_out = max(anulus_r1, anulus_r2)
-
     if args.debug:
         print(
             f"Read {len(sources[:n_objects])} sources from "
@@ -844,51 +1038,109 @@ def spex(options=None):
             file=sys.stderr
         )
 
-    for i, source in enumerate(sources[:n_objects]):
-        progress = (i + 1) / n_objects
-        sys.stderr.write(f"\r{get_pbar(progress)} {progress:.2%}\r")
-        sys.stderr.flush()
+    # Accessing astropy Table rows repeatedly is slow: pull out the
+    # columns needed to build the masks as plain numpy arrays once and
+    # index them by position in the loops below.
+    n_sources = len(sources[:n_objects])
+    src_x = np.asarray(sources['CUBE_X_IMAGE'][:n_objects], dtype=float)
+    src_y = np.asarray(sources['CUBE_Y_IMAGE'][:n_objects], dtype=float)
+    src_ra = np.asarray(sources[args.key_ra][:n_objects], dtype=float)
+    src_dec = np.asarray(sources[args.key_dec][:n_objects], dtype=float)
+
+    if mode in ('kron_ellipse', 'kron_circular'):
+        src_a = np.asarray(sources[args.key_a][:n_objects], dtype=float)
+        src_b = np.asarray(sources[args.key_b][:n_objects], dtype=float)
+        src_kron = np.asarray(sources[args.key_kron][:n_objects], dtype=float)
+
+    if mode == 'kron_ellipse':
+        src_theta = np.asarray(
+            sources[args.key_theta][:n_objects], dtype=float
+        )
+        src_cos = np.cos(np.deg2rad(src_theta))
+        src_sin = np.sin(np.deg2rad(src_theta))
 
-        if key_id is not None:
-            obj_id = source[key_id]
-        else:
-            obj_id = f"{i:06}"
+    if key_id is not None:
+        src_ids = list(sources[key_id][:n_objects])
+    else:
+        src_ids = [f"{i:06}" for i in range(n_sources)]
+
+    # Assign the cube pixels to the sources in a separate cheap pass:
+    # this way the extraction loop below only performs the cube
+    # reductions and the output I/O.
+    source_apertures = []
+
+    for i in range(n_sources):
+        obj_id = src_ids[i]
 
-        obj_ra = source[args.key_ra]
-        obj_dec = source[args.key_dec]
-        xx_tr = xx - source['CUBE_X_IMAGE']
-        yy_tr = yy - source['CUBE_Y_IMAGE']
+        obj_x = src_x[i]
+        obj_y = src_y[i]
 
+        anulus_mask = None
+
+        # Compute the radius of a bounding box that encloses the whole
+        # aperture, so that only a small tile of the cube needs to be
+        # accessed for each object instead of full spatial planes.
         if mode == 'kron_ellipse':
-            ang = np.deg2rad(source[args.key_theta])
+            bbox_radius = src_a[i] / np.sqrt(src_kron[i])
+        elif mode == 'kron_circular':
+            kron_circular = src_kron[i] * src_b[i] / src_a[i]
+            bbox_radius = kron_circular
+        elif mode == 'circular_aperture':
+            bbox_radius = aperture_r_pix
+            if anulus_r_in and anulus_r_out:
+                bbox_radius = max(bbox_radius, anulus_r_out / cube_pixelscale)
 
-            x_over_a = xx_tr*np.cos(ang) + yy_tr*np.sin(ang)
-            x_over_a /= source[args.key_a]
-            x_over_a = x_over_a ** 2
+        bbox_radius = int(np.ceil(bbox_radius))
 
-            y_over_b = xx_tr*np.sin(ang) - yy_tr*np.cos(ang)
-            y_over_b /= source[args.key_b]
-            y_over_b = y_over_b ** 2
+        y0 = max(int(obj_y) - bbox_radius, 0)
+        y1 = min(int(obj_y) + bbox_radius + 1, img_height)
+        x0 = max(int(obj_x) - bbox_radius, 0)
+        x1 = min(int(obj_x) + bbox_radius + 1, img_width)
 
+        if y0 >= y1 or x0 >= x1:
+            print(
+                f"WARNING: object {obj_id} is outside the cube, skipping...",
+                file=sys.stderr
+            )
+            source_apertures.append(None)
+            continue
+
+        # Pixel coordinates of the tile relative to the object center
+        xx_tr = np.arange(x0, x1, dtype=np.float64) - obj_x
+        yy_tr = np.arange(y0, y1, dtype=np.float64) - obj_y
+
+        if mode == 'kron_ellipse':
             spex_apertures[obj_id] = (
-                source[args.key_a] * pixelscale,
-                source[args.key_b] * pixelscale,
-                source[args.key_theta]
+                src_a[i] * pixelscale,
+                src_b[i] * pixelscale,
+                src_theta[i]
             )
 
-            mask = (x_over_a + y_over_b) < (1.0/source[args.key_kron])
+            if HAS_NUMBA:
+                mask = _ellipse_mask(
+                    xx_tr, yy_tr, src_cos[i], src_sin[i],
+                    1.0/src_a[i], 1.0/src_b[i], 1.0/src_kron[i]
+                )
+            else:
+                x_over_a = xx_tr[None, :]*src_cos[i] + yy_tr[:, None]*src_sin[i]
+                x_over_a /= src_a[i]
+                x_over_a = x_over_a ** 2
 
-        elif mode == 'kron_circular':
-            kron_circular = source[args.key_kron] * source[args.key_b]
-            kron_circular /= source[args.key_a]
+                y_over_b = xx_tr[None, :]*src_sin[i] - yy_tr[:, None]*src_cos[i]
+                y_over_b /= src_b[i]
+                y_over_b = y_over_b ** 2
+
+                mask = (x_over_a + y_over_b) < (1.0/src_kron[i])
 
+        elif mode == 'kron_circular':
             spex_apertures[obj_id] = (
                 kron_circular * pixelscale,
                 kron_circular * pixelscale,
                 0
             )
 
-            mask = (xx_tr**2 + yy_tr**2) < (kron_circular ** 2)
+            mask = (xx_tr[None, :]**2 + yy_tr[:, None]**2) \
+                < (kron_circular ** 2)
 
         elif mode == 'circular_aperture':
             # NOTE: in this mode, aperture is already in asrcseconds
@@ -898,8 +1150,8 @@ def spex(options=None):
                 0
             )
 
-            rad_coords = xx_tr**2 + yy_tr**2
-            mask = rad_coords < args.aperture_size / cube_pixelscale
+            rad_coords = xx_tr[None, :]**2 + yy_tr[:, None]**2
+            mask = rad_coords < aperture_r_pix2
 
             if anulus_r_in and anulus_r_out:
                 spex_anuli[obj_id] = (
@@ -907,38 +1159,151 @@ def spex(options=None):
                     anulus_r_out
                 )
 
-                anulus_mask_out = rad_coords <= anulus_r_out / cube_pixelscale
-                anulus_mask_in = rad_coords > anulus_r_in / cube_pixelscale
+                anulus_mask_out = rad_coords <= anulus_r_out_pix2
+                anulus_mask_in = rad_coords > anulus_r_in_pix2
 
                 anulus_mask = anulus_mask_in & anulus_mask_out
             else:
                 spex_anuli[obj_id] = None
-                anulus_mask = None
 
         if cube_footprint is not None:
-            mask &= cube_footprint
+            mask &= cube_footprint[y0:y1, x0:x1]
 
-        if np.sum(mask) == 0:
+        if np.sum(mask) < max(args.min_pixels, 1):
             print(
-                f"WARNING: object {obj_id} has no footprint, skipping...",
+                f"WARNING: object {obj_id} has less than "
+                f"{max(args.min_pixels, 1)} valid pixels, skipping...",
                 file=sys.stderr
             )
+            source_apertures.append(None)
             continue
 
-        obj_spectrum, obj_spectrum_var = get_spectrum(
-            spec_hdu.data[:, mask],
-            var_hdu.data[:, mask] if var_hdu is not None else None
+        source_apertures.append((y0, y1, x0, x1, mask, anulus_mask))
+
+    n_wave = spec_hdu.shape[0]
+
+    # Reusable flux/variance tile buffers, one pair per extraction
+    # thread: copying the tiles into preallocated arrays (converting
+    # them to the native byte order on the way) avoids two fresh
+    # tile-sized allocations per source.
+    max_tile_h = 0
+    max_tile_w = 0
+    for aperture in source_apertures:
+        if aperture is not None:
+            max_tile_h = max(max_tile_h, aperture[1] - aperture[0])
+            max_tile_w = max(max_tile_w, aperture[3] - aperture[2])
+
+    tile_buffers = threading.local()
+
+    def get_tile_buffers(dtype):
+        buffers = getattr(tile_buffers, 'buffers', None)
+        if buffers is None or buffers[0].dtype != dtype:
+            buffers = (
+                np.empty((n_wave, max_tile_h, max_tile_w), dtype=dtype),
+                np.empty((n_wave, max_tile_h, max_tile_w), dtype=dtype)
+            )
+            tile_buffers.buffers = buffers
+        return buffers
+
+    # When a single BOSS spPlate-like file is requested, preallocate
+    # the output arrays: every extraction worker fills its own row.
+    if args.boss:
+        all_spec_data = np.full(
+            (n_sources, n_wave), np.nan, dtype=np.float32
         )
+        if var_hdu is not None:
+            all_var_data = np.full_like(all_spec_data, np.nan)
+        else:
+            all_var_data = None
+    else:
+        all_spec_data = None
+        all_var_data = None
 
-        obj_spectrum = obj_spectrum.filled(np.nan)
-        obj_spectrum_var = obj_spectrum_var.filled(np.nan)
+    # The spectrum/variance extension headers only depend on the cube,
+    # build the template once instead of once per object
+    spec_header_template = get_spsingle_header_template(spec_hdu.header)
+
+    # The spectral part of the WCS is the same for every object:
+    # serializing it to a header involves astropy unit conversions and
+    # is far too expensive to redo once per source
+    spec_wcs_header = spectral_wcs.to_header()
+
+    # Instantiating an astropy Time is surprisingly expensive, a single
+    # timestamp for the whole extraction is more than enough
+    my_time = Time.now()
+    my_time.format = 'isot'
+    extraction_time = str(my_time)
+
+    # Penalty variance assigned to the bad pixels when --no-nans is
+    # used: compute it once from the variance cube instead of scanning
+    # every extracted spectrum
+    if args.no_nans and var_hdu is not None:
+        var_fill_value = 100.0 * np.nanmax(var_hdu.data)
+    else:
+        var_fill_value = None
+
+    # The output fits files are written from a small dedicated pool, so
+    # that the extraction workers only queue the writes instead of
+    # blocking on the disk
+    writer_pool = ThreadPoolExecutor(max_workers=4)
+    write_futures = []
+
+    write_single_files = not args.boss or args.zbest is not None
+    if args.boss and args.zbest is not None:
+        print(
+            "WARNING: redshift estimation requires the individual spectra "
+            "files, writing them alongside the spPlate file...",
+            file=sys.stderr
+        )
+
+    def extract_source(i):
+        """
+        Extract and save the spectrum of a single source.
+
+        Returns the path of the output file and the object ID if the
+        source produced a valid spectrum, otherwise returns None.
+        """
+        y0, y1, x0, x1, mask, anulus_mask = source_apertures[i]
+
+        obj_id = src_ids[i]
+
+        obj_ra = src_ra[i]
+        obj_dec = src_dec[i]
+
+        # Read only the tile assigned to this source from the cube
+        sub_spec = spec_hdu.section[:, y0:y1, x0:x1]
+        sub_var = var_hdu.section[:, y0:y1, x0:x1] if var_hdu is not None \
+            else None
+
+        if HAS_NUMBA and sub_var is not None:
+            # FITS data is big endian (and possibly float64): copying
+            # the tiles into native-order float32 buffers halves the
+            # memory traffic of the reduction, whose accumulators are
+            # float64 anyway
+            flux_buffer, var_buffer = get_tile_buffers(np.float32)
+            flux_tile = flux_buffer[:, :y1 - y0, :x1 - x0]
+            var_tile = var_buffer[:, :y1 - y0, :x1 - x0]
+            np.copyto(flux_tile, sub_spec)
+            np.copyto(var_tile, sub_var)
+
+            obj_spectrum, obj_spectrum_var = _extract_spectrum(
+                flux_tile, var_tile, mask
+            )
+        else:
+            obj_spectrum, obj_spectrum_var = get_spectrum(
+                sub_spec[:, mask],
+                sub_var[:, mask] if sub_var is not None else None
+            )
+
+            obj_spectrum = obj_spectrum.filled(np.nan)
+            obj_spectrum_var = obj_spectrum_var.filled(np.nan)
 
         if np.sum(np.isnan(obj_spectrum_var[~np.isnan(obj_spectrum)])) != 0:
             print(
                 f"\nWARNING: object {obj_id}  is weird! Skipping...\n",
                 file=sys.stderr
             )
-            continue
+            return None
 
         if np.sum(~np.isnan(obj_spectrum)) < 100:
             print(
@@ -951,7 +1316,7 @@ def spex(options=None):
             # Here we suppose that background vaies very slowly within object
             # aperture. In this case we can copute the mean background and
             # subtract it total contribution within the aperture.
-            bkg_spectrum = np.median(spec_hdu.data[:, mask], axis=0)
+            bkg_spectrum = np.median(sub_spec[:, mask], axis=0)
             smoothed_bkg_spectrum = savgol_filter(bkg_spectrum, 51, 11)
             obj_spectrum -= smoothed_bkg_spectrum*np.sum(mask)
 
@@ -962,7 +1327,7 @@ def spex(options=None):
                     "skipping...",
                     file=sys.stderr
                 )
-            continue
+            return None
 
         sn_spec = get_spectrum_snr(obj_spectrum, obj_spectrum_var)
         sn_em = get_spectrum_snr_emission(obj_spectrum, obj_spectrum_var)
@@ -975,10 +1340,15 @@ def spex(options=None):
                     f"{args.sn_threshold}, skipping...",
                     file=sys.stderr
                 )
-            continue
+            return None
+
+        if all_spec_data is not None:
+            all_spec_data[i] = obj_spectrum
+            if all_var_data is not None and obj_spectrum_var is not None:
+                all_var_data[i] = obj_spectrum_var
 
-        my_time = Time.now()
-        my_time.format = 'isot'
+        if not write_single_files:
+            return None, obj_id
 
         outname = f"spec_{obj_id}.fits"
 
@@ -987,38 +1357,96 @@ def spex(options=None):
             'RA': (obj_ra, "Ra of the center of the object"),
             'DEC': (obj_dec, "Dec of the center of the object"),
             'NPIX': (np.sum(mask), 'Number of pixels used for this spectra'),
-            'HISTORY': f'Extracted on {str(my_time)}',
+            'HISTORY': f'Extracted on {extraction_time}',
             'ID': obj_id,
             'SN': (sn_spec, "SNR of the total spectrum"),
             'SN_EMISS': (sn_em, "SNR due to emissino lines only")
         }
 
-        # Copy the spectral part of the WCS into the new FITS
-        spec_wcs_header = spectral_wcs.to_header()
-
         hdul = get_spsingle_fits(
             main_header, spec_wcs_header,
             obj_spectrum, spec_hdu.header,
-            obj_spectrum_var, no_nans=args.no_nans
+            obj_spectrum_var, no_nans=args.no_nans,
+            header_template=spec_header_template,
+            var_fill_value=var_fill_value
         )
 
         out_file_name = os.path.join(outdir, outname)
-        hdul.writeto(
-            out_file_name,
-            overwrite=True
+        write_futures.append(
+            writer_pool.submit(hdul.writeto, out_file_name, overwrite=True)
         )
 
-        # If we arrived here, then the object has a vail spectrum and can be
-        # saved. Let's also mark the object as valid and store its ID
-        out_specfiles.append(os.path.realpath(out_file_name))
-        source_ids.append(obj_id)
-        valid_sources_mask[i] = True
+        return os.path.realpath(out_file_name), obj_id
+
+    # The per-source work is dominated by memmapped cube reads, numpy
+    # reductions and FITS writes, which all release the GIL, so a
+    # thread pool can run the extractions in parallel without copying
+    # the cube to worker processes.
+    extract_indexes = [
+        i for i in range(len(source_apertures))
+        if source_apertures[i] is not None
+    ]
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        futures = {
+            i: executor.submit(extract_source, i)
+            for i in extract_indexes
+        }
+
+        # Collect the results in catalog order so that source_ids and
+        # out_specfiles stay aligned with the filtered sources table.
+        for progress_i, i in enumerate(extract_indexes):
+            result = futures[i].result()
 
-        # Add also the extracted pixels to the extraction map
-        if args.check_images:
-            extracted_data += mask
-            if anulus_mask is not None:
-                extracted_data -= anulus_mask
+            progress = (progress_i + 1) / len(extract_indexes)
+            sys.stderr.write(f"\r{get_pbar(progress)} {progress:.2%}\r")
+            sys.stderr.flush()
+
+            if result is None:
+                continue
+
+            out_file_name, obj_id = result
+            if out_file_name is not None:
+                out_specfiles.append(out_file_name)
+            source_ids.append(obj_id)
+            valid_sources_mask[i] = True
+
+            # Add also the extracted pixels to the extraction map
+            if args.check_images:
+                y0, y1, x0, x1, mask, anulus_mask = source_apertures[i]
+                extracted_data[y0:y1, x0:x1] += mask
+                if anulus_mask is not None:
+                    extracted_data[y0:y1, x0:x1] -= anulus_mask
+
+    # Wait for all the queued writes to hit the disk and surface any
+    # error they may have raised
+    for write_future in write_futures:
+        write_future.result()
+    writer_pool.shutdown()
+
+    if args.boss:
+        valid_idx = np.flatnonzero(valid_sources_mask[:n_sources])
+        try:
+            fiber_ids = [int(src_ids[j]) for j in valid_idx]
+        except (TypeError, ValueError):
+            # FIBERID must be an integer, fall back to the one-based
+            # position of the object in the input catalog
+            fiber_ids = (valid_idx + 1).tolist()
+
+        spplate_hdul = get_spplate_fits(
+            hdl[args.info_hdu].header,
+            spec_hdu.header,
+            fiber_ids,
+            all_spec_data[valid_idx],
+            all_var_data[valid_idx] if all_var_data is not None else None
+        )
+
+        spplate_file_name = os.path.join(outdir, f"spPlate-{basename}.fits")
+        spplate_hdul.writeto(spplate_file_name, overwrite=True)
+        print(
+            f"Saved the extracted spectra to {spplate_file_name}",
+            file=sys.stderr
+        )
 
     # Discard all invalid sources
     sources = sources[valid_sources_mask]
@@ -1081,7 +1509,8 @@ def spex(options=None):
             plt.close(fig)
 
         if args.cutouts_image:
-            cutouts_image = fits.getdata(args.cutouts_image).transpose(1, 2, 0)
+            # Use a view instead of a transposed copy of the whole image
+            cutouts_image = np.moveaxis(fits.getdata(args.cutouts_image), 0, 2)
             cutouts_wcs = wcs.WCS(fits.getheader(args.cutouts_image))
             cutouts_wcs = cutouts_wcs.celestial
             cutout_wcs_frame = wcs.utils.wcs_to_celestial_frame(cutouts_wcs)
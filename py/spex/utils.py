@@ -8,6 +8,8 @@ This module provides utility functions used by other spex modules.
 Copyright (C) 2022  Maurizio D'Addona <mauritiusdadd@gmail.com>
 """
 import sys
+import warnings
+
 import numpy as np
 
 import matplotlib.pyplot as plt
@@ -21,6 +23,20 @@ from astropy.visualization import ZScaleInterval
 
 from .lines import get_lines
 
+try:
+    import numba
+except ImportError:
+    HAS_NUMBA = False
+else:
+    HAS_NUMBA = True
+
+try:
+    import cupy
+except ImportError:
+    HAS_CUPY = False
+else:
+    HAS_CUPY = True
+
 
 def get_pbar(partial, total=None, wid=32, common_char='\u2588',
              upper_char='\u2584', lower_char='\u2580'):
@@ -248,11 +264,10 @@ def get_cutout(data, position, cutout_size, wcs=None, wave_ranges=None,
         cutout_b = Cutout2D(
             data_b, position, cutout_size, wcs=wcs, copy=True
         )
-        cutout = np.array([
-            cutout_r.data,
-            cutout_g.data,
-            cutout_b.data
-        ]).transpose(1, 2, 0)
+        cutout = np.stack(
+            [cutout_r.data, cutout_g.data, cutout_b.data],
+            axis=-1
+        )
 
         if vmin is not None:
             cutout[cutout <= vmin] = vmin
@@ -683,108 +698,331 @@ def nannmad(x, scale=1.48206, axis=None):
         The NMAD value.
 
     """
-    x = np.ma.array(x, mask=np.isnan(x))
-    x_bar = np.ma.median(x, axis=axis)
-    mad = np.ma.median(np.ma.abs(x - x_bar), axis=axis)
+    if isinstance(x, np.ma.MaskedArray):
+        x = x.filled(np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        x_bar = np.nanmedian(x, axis=axis)
+        if axis is not None:
+            # Keep the reduced axis so the subtraction below broadcasts
+            # correctly whatever axis is used.
+            x_bar = np.expand_dims(x_bar, axis)
+        mad = np.nanmedian(np.abs(x - x_bar), axis=axis)
     return scale*mad
 
 
-def get_spectrum_snr(flux, var=None, smoothing_window=51, smoothing_order=11):
+def get_spectrum_snr(flux, var=None, smoothing_window=51, smoothing_order=11,
+                     axis=-1, ivar=None):
     """
-    Compute the SRN of a spectrum.
+    Compute the SRN of one or more spectra.
 
     Parameters
     ----------
     flux : numpy.ndarray
-        The spectrum itself.
+        The spectrum itself or a stack of spectra.
     smoothing_window : int, optional
         Parameter to be passed to the smoothing function.
         The default is 51.
     smoothing_order : int, optional
         Parameter to be passed to the smoothing function.
         The default is 11.
+    axis : int, optional
+        The axis of flux along which the wavelength varies. This allows
+        to compute the SNR of many spectra at once, for example passing
+        a (nlambda, nspaxels) view of a specral cube with axis=0.
+        The default is -1.
+    ivar : numpy.ndarray, optional
+        Precomputed inverse of var, which is then ignored. The variance
+        only enters the estimators through its reciprocal, so callers
+        running several of them can invert it once and share the
+        result. The default is None.
 
     Returns
     -------
-    sn_spec : float
-        The SNR of the spectrum.
+    sn_spec : float or numpy.ndarray
+        The SNR of the spectrum (one value per input spectrum).
 
     """
     # DER-like SNR but with a true smoothing
     # https://stdatu.stsci.edu/vodocs/der_snr.pdf
     # Smoothing the spectrum to get a crude approximation of the continuum
 
-    if np.isnan(flux).all():
-        return np.nan
-    else:
-        flux = np.ma.array(flux, mask=np.isnan(flux))
+    # NaNs play the role of masked values: the nan-aware reductions
+    # skip the same elements the old masked arrays did, without
+    # allocating a mask buffer alongside every intermediate array.
+    if isinstance(flux, np.ma.MaskedArray):
+        flux = flux.filled(np.nan)
+    if isinstance(var, np.ma.MaskedArray):
+        var = var.filled(np.nan)
+    if isinstance(ivar, np.ma.MaskedArray):
+        ivar = ivar.filled(np.nan)
 
-    if var is not None:
-        var = np.ma.array(var, mask=np.isnan(var))
-    else:
-        var = 1.0
+    if np.isnan(flux).all():
+        if flux.ndim == 1:
+            return np.nan
+        return np.full(np.delete(flux.shape, axis), np.nan)
 
-    smoothed_spec = savgol_filter(flux, smoothing_window, smoothing_order)
-    smoothed_spec = np.ma.array(smoothed_spec, mask=np.isnan(smoothed_spec))
+    smoothed_spec = savgol_filter(flux, smoothing_window, smoothing_order,
+                                  axis=axis)
 
     # Subtract the smoothed spectrum to the spectrum itself to get a
     # crude estimation of the noise
     noise_spec = flux - smoothed_spec
 
-    # Get the median value of the spectrum, weighted by the variance
-    obj_mean_spec = np.ma.sum(smoothed_spec / var) / np.ma.sum(1 / var)
+    with warnings.catch_warnings(), np.errstate(invalid='ignore',
+                                                divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        if ivar is None and var is not None:
+            ivar = 1.0 / var
+
+        # Get the median value of the spectrum, weighted by the variance
+        if ivar is not None:
+            obj_mean_spec = np.nansum(smoothed_spec * ivar, axis=axis)
+            obj_mean_spec = obj_mean_spec / np.nansum(ivar, axis=axis)
+        else:
+            obj_mean_spec = np.nansum(smoothed_spec, axis=axis)
 
-    # Get the mean Signal to Noise ratio
-    sn_spec = obj_mean_spec / nannmad(noise_spec)
+        # Get the mean Signal to Noise ratio
+        sn_spec = obj_mean_spec / nannmad(noise_spec, axis=axis)
 
     return sn_spec
 
 
-def get_spectrum_snr_emission(flux, var=None, bin_size=50):
+if HAS_NUMBA:
+    # The kernels are compiled eagerly, with explicit signatures: the
+    # compilation cost is paid once at import time (and amortized across
+    # runs by the on-disk cache) instead of stalling the first call.
+    @numba.njit(
+        numba.float64(numba.float64[:], numba.float64[:]),
+        nogil=True, cache=True
+    )
+    def _nanmedian_1d(values, scratch):
+        """Compute the median of a 1D array ignoring NaNs."""
+        n_good = 0
+        for i in range(values.shape[0]):
+            val = values[i]
+            if not np.isnan(val):
+                scratch[n_good] = val
+                n_good += 1
+        if n_good == 0:
+            return np.nan
+        return np.median(scratch[:n_good])
+
+    @numba.njit(
+        [
+            numba.float64[:](numba.float32[:, :], numba.int64, numba.float64),
+            numba.float64[:](numba.float64[:, :], numba.int64, numba.float64),
+        ],
+        parallel=True, nogil=True, cache=True
+    )
+    def _emission_snr_kernel(flux, bin_size, scale):
+        """
+        Compute the emission SNR of a stack of spectra.
+
+        This is the scalar-loop version of get_spectrum_snr_emission:
+        flux must be a 2D array of shape (nspec, nlambda), already
+        weighted by the variance and truncated to a multiple of
+        bin_size, with invalid values set to NaN. Spectra are processed
+        in parallel and each one uses only a couple of small per-bin
+        scratch buffers instead of the large masked intermediates of
+        the numpy version.
+        """
+        n_spec = flux.shape[0]
+        n_bins = flux.shape[1] // bin_size
+        snr = np.full(n_spec, np.nan)
+        for j in numba.prange(n_spec):
+            sub_diff = np.empty(n_bins)
+            scratch = np.empty(bin_size)
+            for b in range(n_bins):
+                vmax = -np.inf
+                n_good = 0
+                for i in range(bin_size):
+                    val = flux[j, b*bin_size + i]
+                    if not np.isnan(val):
+                        scratch[n_good] = val
+                        n_good += 1
+                        if val > vmax:
+                            vmax = val
+                if n_good == 0:
+                    sub_diff[b] = np.nan
+                else:
+                    sub_diff[b] = vmax - np.median(scratch[:n_good])
+
+            bin_scratch = np.empty(n_bins)
+            med_diff = _nanmedian_1d(sub_diff, bin_scratch)
+            if np.isnan(med_diff):
+                continue
+
+            n_good = 0
+            for b in range(n_bins):
+                if not np.isnan(sub_diff[b]):
+                    bin_scratch[n_good] = abs(sub_diff[b] - med_diff)
+                    n_good += 1
+            noise_em = scale * np.median(bin_scratch[:n_good])
+
+            best = np.nan
+            for b in range(n_bins):
+                s_em = sub_diff[b] / 3.0*med_diff - 1
+                val = s_em / noise_em
+                if not np.isnan(val) and not (val <= best):
+                    best = val
+            snr[j] = best
+        return snr
+
+
+def get_spectrum_snr_emission(flux, var=None, bin_size=50, axis=-1,
+                              ivar=None):
     """
     Compute the SRN of a spectrum considering emission lines only.
 
     Parameters
     ----------
     flux : numpy.ndarray
-        The spectrum itself.
+        The spectrum itself or a stack of spectra.
     bin_size : int, optional
         Bin size to search for emission lines.
         The default is 50.
+    axis : int, optional
+        The axis of flux along which the wavelength varies (see
+        get_spectrum_snr). The default is -1.
+    ivar : numpy.ndarray, optional
+        Precomputed inverse of var, which is then ignored (see
+        get_spectrum_snr). The default is None.
 
     Returns
     -------
-    sn_spec : float
-        The SNR of the spectrum.
+    sn_spec : float or numpy.ndarray
+        The SNR of the spectrum (one value per input spectrum).
 
     """
     # Inspired by https://www.aanda.org/articles/aa/pdf/2012/03/aa17774-11.pdf
 
-    # Just ignore negative fluxes!
-    flux[flux < 0] = 0
+    # NaNs play the role of masked values, see get_spectrum_snr
+    if isinstance(flux, np.ma.MaskedArray):
+        flux = flux.filled(np.nan)
+    if isinstance(var, np.ma.MaskedArray):
+        var = var.filled(np.nan)
+    if isinstance(ivar, np.ma.MaskedArray):
+        ivar = ivar.filled(np.nan)
+
+    # Move the spectral axis to the last position so that the rebinning
+    # below can be done with a simple reshape
+    flux = np.moveaxis(flux, axis, -1)
+
+    # Just ignore negative fluxes! (np.where also avoids overwriting the
+    # input array in place)
+    flux = np.where(flux < 0, 0, flux)
 
     # If we have the variace, we can use it to weight the flux
-    if var is not None:
-        flux = flux / var
+    if ivar is None and var is not None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ivar = 1.0 / var
+
+    if ivar is not None:
+        flux = flux * np.moveaxis(ivar, axis, -1)
 
-    optimal_width = flux.shape[0] - flux.shape[0] % bin_size
-    flux = flux[:optimal_width]
+    optimal_width = flux.shape[-1] - flux.shape[-1] % bin_size
+    flux = flux[..., :optimal_width]
 
     if np.isnan(flux).all():
-        return np.nan
-    else:
-        flux = np.ma.array(flux, mask=np.isnan(flux))
+        if flux.ndim == 1:
+            return np.nan
+        return np.full(flux.shape[:-1], np.nan)
+
+    if HAS_NUMBA and flux.ndim == 2 and flux.dtype in (np.float32,
+                                                       np.float64):
+        # Scale factor is the default of nannmad
+        return _emission_snr_kernel(flux, bin_size, 1.48206)
 
     # Rebin sub_spec to search for emission features
-    sub_spec = flux.reshape(flux.shape[0] // bin_size, bin_size)
+    sub_spec = flux.reshape(
+        flux.shape[:-1] + (optimal_width // bin_size, bin_size)
+    )
+
+    with warnings.catch_warnings(), np.errstate(invalid='ignore',
+                                                divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        # For each bin we compute the maximum and the median of each bin
+        # and get their difference. This is now our "signal": if there is
+        # an emission line, the maximum value is greater that the median
+        # and this difference will be greater than one
+        sub_diff = np.nanmax(sub_spec, axis=-1)
+        sub_diff = sub_diff - np.nanmedian(sub_spec, axis=-1)
+
+        s_em = sub_diff / 3.0*np.nanmedian(sub_diff, axis=-1, keepdims=True)
+        s_em = s_em - 1
+        noise_em = np.expand_dims(nannmad(sub_diff, axis=-1), -1)
+
+        return np.nanmax(s_em / noise_em, axis=-1)
+
+
+if HAS_CUPY:
+    def _gpu_nannmad(x, scale=1.48206, axis=-1):
+        """Compute the NMAD of a cupy array ignoring NaNs."""
+        x_bar = cupy.nanmedian(x, axis=axis, keepdims=True)
+        return scale*cupy.nanmedian(cupy.abs(x - x_bar), axis=axis)
+
+    def get_spectrum_snr_gpu(flux, var=None, smoothing_window=51,
+                             smoothing_order=11, axis=-1):
+        """
+        Compute the SNR of a stack of spectra on the GPU.
+
+        Same estimator as get_spectrum_snr, but operating on cupy
+        arrays; NaNs play the role of the masked values. If the cupy
+        installation does not provide savgol_filter, the computation
+        silently falls back to the CPU implementation.
+        """
+        try:
+            from cupyx.scipy.signal import savgol_filter as gpu_savgol
+        except ImportError:
+            return cupy.asarray(
+                get_spectrum_snr(
+                    cupy.asnumpy(flux),
+                    cupy.asnumpy(var) if var is not None else None,
+                    smoothing_window, smoothing_order, axis
+                )
+            )
+
+        smoothed_spec = gpu_savgol(
+            flux, smoothing_window, smoothing_order, axis=axis
+        )
+        noise_spec = flux - smoothed_spec
+
+        if var is not None:
+            obj_mean_spec = cupy.nansum(smoothed_spec / var, axis=axis)
+            obj_mean_spec = obj_mean_spec / cupy.nansum(1 / var, axis=axis)
+        else:
+            obj_mean_spec = cupy.nansum(smoothed_spec, axis=axis)
+
+        return obj_mean_spec / _gpu_nannmad(noise_spec, axis=axis)
+
+    def get_spectrum_snr_emission_gpu(flux, var=None, bin_size=50, axis=-1):
+        """
+        Compute the emission SNR of a stack of spectra on the GPU.
+
+        Same estimator as get_spectrum_snr_emission, but operating on
+        cupy arrays; NaNs play the role of the masked values.
+        """
+        flux = cupy.moveaxis(flux, axis, -1)
+        flux = cupy.where(flux < 0, 0, flux)
+
+        if var is not None:
+            flux = flux / cupy.moveaxis(var, axis, -1)
+
+        optimal_width = flux.shape[-1] - flux.shape[-1] % bin_size
+        flux = flux[..., :optimal_width]
+
+        sub_spec = flux.reshape(
+            flux.shape[:-1] + (optimal_width // bin_size, bin_size)
+        )
 
-    # For each bin we compute the maximum and the median of each bin and
-    # get their difference. This is now our "signal": if there is an
-    # emission line, the maximum value is greater that the median and this
-    # difference will be greater than one
-    sub_diff = np.ma.max(sub_spec, axis=1) - np.ma.median(sub_spec, axis=1)
+        sub_diff = cupy.nanmax(sub_spec, axis=-1)
+        sub_diff = sub_diff - cupy.nanmedian(sub_spec, axis=-1)
 
-    s_em = sub_diff / 3.0*np.ma.median(sub_diff) - 1
-    noise_em = nannmad(sub_diff)
+        s_em = sub_diff / 3.0*cupy.nanmedian(sub_diff, axis=-1, keepdims=True)
+        s_em = s_em - 1
+        noise_em = cupy.expand_dims(_gpu_nannmad(sub_diff, axis=-1), -1)
 
-    return np.ma.max(s_em / noise_em)
+        return cupy.nanmax(s_em / noise_em, axis=-1)